@@ -1,7 +1,18 @@
+from .attachments import attachments_router
 from .chat import chat_router
+from .debug import debug_router
+from .health import health_router
+from .metrics import metrics_router
 from .users import user_router
 
-routers_list = [user_router, chat_router]
+routers_list = [
+    user_router,
+    chat_router,
+    attachments_router,
+    metrics_router,
+    health_router,
+    debug_router,
+]
 
 __all__ = [
     "routers_list",
@@ -0,0 +1,63 @@
+from urllib.parse import quote
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from misc.storage import AttachmentTooLarge, is_attachment_id
+from schemas.others import StatusResponse
+from schemas.users import UserDTO
+from utils.auth import get_current_user
+
+attachments_router = APIRouter(
+    prefix="/attachments",
+    tags=["attachments"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+# The body is the raw file content, streamed to storage chunk by chunk
+@attachments_router.post("/", response_model=StatusResponse)
+async def upload_attachment(
+    request: Request,
+    name: str,
+    user: UserDTO = Depends(get_current_user),
+):
+    config = request.app.state.config.attachments
+    storage = request.app.state.storage
+
+    content_length = request.headers.get("content-length")
+    if content_length:
+        if not content_length.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if int(content_length) > config.max_size:
+            raise HTTPException(status_code=413, detail="Attachment is too large")
+
+    try:
+        attachment = await storage.save(request.stream(), config.max_size)
+    except AttachmentTooLarge:
+        raise HTTPException(status_code=413, detail="Attachment is too large")
+
+    return StatusResponse(
+        status="ok",
+        data={"id": attachment.id, "size": attachment.size, "name": name},
+    )
+
+
+@attachments_router.get("/{attachment_id}")
+async def download_attachment(
+    request: Request, attachment_id: str, name: str | None = None
+):
+    storage = request.app.state.storage
+    if not is_attachment_id(attachment_id) or not await storage.exists(attachment_id):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    filename = quote(name or attachment_id)
+    return StreamingResponse(
+        storage.read(attachment_id),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{filename}",
+            # Content addressed, so the body never changes for a given id
+            "Cache-Control": "public, max-age=31536000, immutable",
+        },
+    )
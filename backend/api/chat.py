@@ -1,76 +1,253 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from misc.connection_manager import ConnectionManager
-from schemas.messages import CachedMessageDTO
+import asyncio
+import json
+import re
+
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import StreamingResponse
+from misc.metrics import MESSAGES_DELIVERED, MESSAGES_RECEIVED
+from misc.profiling import span
+from misc.storage import format_attachment_reference, is_attachment_id
 from schemas.users import UserDTO
-from utils.cache import cache_message, get_cached_messages
+from utils.cache import (
+    cache_message,
+    get_cursor,
+    get_history,
+    get_messages_after,
+    new_message,
+    next_seq,
+    save_cursors,
+)
+from utils.auth import get_current_user, require_admin
+from utils.export import export_conversation, export_formats
+from utils.outbox import notify_later
 
 from database.orm import AsyncORM
 
-manager = ConnectionManager()
-
 chat_router = APIRouter(
     prefix="/chat",
     tags=["chat"],
     responses={404: {"description": "Not found"}},
 )
 
+CONTROL_FRAME_TYPES = {"typing", "heartbeat", "pong", "attachment"}
+MAX_ATTACHMENT_NAME_LENGTH = 255
+DEVICE_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def parse_control_frame(data: str) -> dict | None:
+    """Returns the decoded frame if it is a control event rather than a chat message"""
+    if not data.startswith("{"):
+        return None
+    try:
+        frame = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(frame, dict) and frame.get("type") in CONTROL_FRAME_TYPES:
+        return frame
+    return None
+
 
 @chat_router.websocket("/ws/{sender_id}/{receiver_id}")
 async def websocket_chat(
     websocket: WebSocket,
     sender_id: int,
     receiver_id: int,
+    device_id: str | None = None,
 ):
-    await manager.connect(websocket, sender_id)
+    manager = websocket.app.state.manager
+    presence = websocket.app.state.presence
+    rate_limiter = websocket.app.state.rate_limiter
+    storage = websocket.app.state.storage
+    max_message_length = websocket.app.state.config.attachments.max_message_length
+
+    if manager.draining:
+        # The node is shutting down, the client should pick another one
+        await manager.refuse(websocket, websocket.app.state.config.drain)
+        return
+
+    if device_id is not None and not DEVICE_ID_RE.fullmatch(device_id):
+        # Accepted first, a close before the handshake reaches the browser as 1006
+        await websocket.accept()
+        await websocket.close(code=1008, reason="Invalid device id")
+        return
+
+    connection = await manager.connect(websocket, sender_id, receiver_id, device_id)
 
     redis = websocket.app.state.redis
+    cache_config = websocket.app.state.config.cache
+    outbox_config = websocket.app.state.config.outbox
 
-    # Retrieve cached messages from Redis or fetch from the database if not available
-    messages = await get_cached_messages(redis, sender_id, receiver_id)
-    if not messages:
-        messages = await AsyncORM.messages.get_chat_history(sender_id, receiver_id)
-        for message in messages:
-            await cache_message(
-                redis,
-                CachedMessageDTO.model_validate(message),
+    # Unregistered on any exit, also when loading history or presence fails
+    try:
+        # A known device only gets what it missed, anything else the latest history
+        cursor = None
+        if device_id is not None:
+            cursor = await get_cursor(redis, sender_id, receiver_id, device_id)
+        if cursor is None:
+            messages = await get_history(redis, cache_config, sender_id, receiver_id)
+        else:
+            messages = await get_messages_after(
+                redis, cache_config, sender_id, receiver_id, cursor
             )
 
-    # Send existing messages to the connected user
-    for message in messages:
-        await websocket.send_text(f"{message.sender.username}: {message.message}")
+        # Send existing messages to the connected user
+        for message in messages:
+            await connection.send_text(f"{message.sender.username}: {message.message}")
+        await save_cursors(
+            redis,
+            cache_config,
+            sender_id,
+            receiver_id,
+            [connection],
+            messages,
+            after=cursor,
+        )
+
+        await presence.user_connected(connection)
+
+        bucket = rate_limiter.connection_bucket()
+        violations = 0
 
-    try:
         while True:
             data = await websocket.receive_text()
 
-            sender = await AsyncORM.users.get(sender_id)
-
-            await cache_message(
-                redis,
-                CachedMessageDTO(
-                    id=None,
-                    sender_id=sender_id,
-                    receiver_id=receiver_id,
-                    message=data,
-                    sender=UserDTO.model_validate(sender),
-                    timestamp=None,
-                ),
-            )
+            # One span per frame, covers rate limiting, caching and delivery
+            with span("ws.frame", user_id=sender_id, peer_id=receiver_id):
+                connection.touch()
 
-            # Send the message to the intended recipient
-            sent = await manager.send_personal_message(
-                f"{sender.username}: {data}", receiver_id
-            )
+                frame = parse_control_frame(data)
+
+                # Every frame costs a local token, chat messages also a global one
+                retry_after = rate_limiter.check_connection(bucket)
+                if not retry_after and (frame is None or frame["type"] == "attachment"):
+                    retry_after = await rate_limiter.check_user(sender_id)
+
+                if retry_after:
+                    violations += 1
+                    if violations >= rate_limiter.config.max_violations:
+                        await websocket.close(code=1008, reason="Rate limit exceeded")
+                        break
+                    await connection.send_json(
+                        {
+                            "type": "error",
+                            "code": "rate_limited",
+                            "retry_after": round(retry_after, 3),
+                        }
+                    )
+                    continue
+                violations = 0
+
+                await presence.heartbeat(sender_id)
 
-            # If the recipient is not connected, send a message to their Telegram
-            if not sent:
-                celery_app = websocket.app.state.celery
-                receiver = await AsyncORM.users.get(receiver_id)
-                if receiver.tg_user_id:
-                    celery_app.send_task(
-                        "tasks.SendMessageToTG",
-                        args=[receiver.tg_user_id, sender.username, data],
+                if frame is not None and frame["type"] == "attachment":
+                    # Only a reference travels through the chat, the file was uploaded over HTTP
+                    attachment_id = str(frame.get("id", ""))
+                    name = str(frame.get("name", ""))[:MAX_ATTACHMENT_NAME_LENGTH]
+                    if not is_attachment_id(attachment_id) or not await storage.exists(
+                        attachment_id
+                    ):
+                        await connection.send_json(
+                            {"type": "error", "code": "unknown_attachment"}
+                        )
+                        continue
+                    data = format_attachment_reference(attachment_id, name)
+                elif frame is not None:
+                    if frame["type"] == "typing":
+                        await presence.typing(sender_id, receiver_id)
+                    continue
+                elif len(data) > max_message_length:
+                    await connection.send_json(
+                        {
+                            "type": "error",
+                            "code": "message_too_large",
+                            "max_length": max_message_length,
+                        }
                     )
+                    continue
+
+                MESSAGES_RECEIVED.inc()
+                sender = await AsyncORM.users.get(sender_id)
+
+                # Numbered on receipt, this fixes its place in the history
+                seq = await next_seq(redis, cache_config, sender_id, receiver_id)
+                message = new_message(UserDTO.model_validate(sender), receiver_id, seq, data)
+
+                # Only the recipient's devices that have this conversation open
+                # get it live. With none, the Telegram notification is staged
+                # together with the message and relayed later
+                receiver_devices = [
+                    device
+                    for device in manager.devices_of(receiver_id)
+                    if device.peer_id == sender_id
+                ]
+                receiver_offline = not receiver_devices
+                await cache_message(
+                    redis,
+                    cache_config,
+                    message,
+                    notify=outbox_config if receiver_offline else None,
+                )
+
+                # Send the message to the recipient, and to the sender's other
+                # devices that have this conversation open
+                text = f"{sender.username}: {data}"
+                own_devices = [
+                    device
+                    for device in manager.devices_of(sender_id)
+                    if device is not connection and device.peer_id == receiver_id
+                ]
+                delivered, echoed = await asyncio.gather(
+                    manager.send_many(receiver_devices, text),
+                    manager.send_many(own_devices, text),
+                )
+                await save_cursors(
+                    redis,
+                    cache_config,
+                    sender_id,
+                    receiver_id,
+                    [connection, *echoed, *delivered],
+                    [message],
+                )
+
+                if delivered:
+                    MESSAGES_DELIVERED.inc()
+                elif not receiver_offline:
+                    # The recipient's sockets died since the check
+                    await notify_later(redis, outbox_config, message)
 
     except WebSocketDisconnect:
-        manager.disconnect(sender_id)
+        pass
+    finally:
+        manager.disconnect(connection)
+        await presence.user_disconnected(sender_id)
+
+
+# Compliance export of a whole conversation, for an admin or one of its participants
+@chat_router.get("/export/{sender_id}/{receiver_id}")
+async def export_chat(
+    request: Request,
+    sender_id: int,
+    receiver_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+):
+    try:
+        await require_admin(request)
+    except HTTPException:
+        user = await get_current_user(request)
+        if user.id not in (sender_id, receiver_id):
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+    media_type, extension, _ = export_formats[format]
+    filename = f"chat-{min(sender_id, receiver_id)}-{max(sender_id, receiver_id)}.{extension}"
+    return StreamingResponse(
+        export_conversation(request.app.state.redis, sender_id, receiver_id, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from misc.profiling import SamplingProfiler, format_folded
+from utils.auth import require_admin
+
+debug_router = APIRouter(
+    prefix="/debug",
+    tags=["debug"],
+    dependencies=[Depends(require_admin)],
+)
+
+# One profile at a time per worker, overlapping samplers would skew each other
+_profile_lock = asyncio.Lock()
+
+
+# Samples the event loop thread of the worker serving the request
+@debug_router.post("/profile", response_class=PlainTextResponse)
+async def capture_profile(request: Request, seconds: float = Query(10, gt=0)):
+    config = request.app.state.config.profiling
+    if seconds > config.max_profile_seconds:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {config.max_profile_seconds:g} seconds",
+        )
+    if _profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    async with _profile_lock:
+        profiler = SamplingProfiler(threading.get_ident(), config.sample_interval)
+        samples = await run_in_threadpool(profiler.run, seconds)
+
+    return PlainTextResponse(format_folded(samples))
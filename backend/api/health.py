@@ -0,0 +1,82 @@
+import asyncio
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from schemas.others import StatusResponse
+from utils.auth import require_admin
+from utils.drain import drain
+
+health_router = APIRouter(
+    prefix="/health",
+    tags=["health"],
+)
+
+# Seconds a single dependency check may take before it counts as failed
+CHECK_TIMEOUT = 2
+
+
+async def check_database(request: Request):
+    if not request.app.state.db_ready:
+        raise RuntimeError("migrations have not been applied yet")
+    async with request.app.state.engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+
+async def check_redis(request: Request):
+    await request.app.state.redis.ping()
+
+
+def _ping_broker(celery_app):
+    with celery_app.connection_for_write() as conn:
+        conn.ensure_connection(max_retries=1)
+
+
+async def check_celery(request: Request):
+    await run_in_threadpool(_ping_broker, request.app.state.celery)
+
+
+async def _run_check(check, request: Request) -> str:
+    try:
+        await asyncio.wait_for(check(request), timeout=CHECK_TIMEOUT)
+    except Exception as e:
+        return f"error: {e.__class__.__name__}: {e}"
+    return "ok"
+
+
+# The process is up and serving requests
+@health_router.get("/live")
+async def liveness():
+    return {"status": "ok"}
+
+
+# The process can do useful work: Postgres, Redis and the Celery broker answer
+@health_router.get("/ready")
+async def readiness(request: Request):
+    checks = {
+        "database": check_database,
+        "redis": check_redis,
+        "celery": check_celery,
+    }
+    results = await asyncio.gather(
+        *(_run_check(check, request) for check in checks.values())
+    )
+    data = dict(zip(checks, results))
+    data["draining"] = request.app.state.manager.draining
+    ready = all(result == "ok" for result in results) and not data["draining"]
+
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ok" if ready else "unavailable", "checks": data},
+    )
+
+
+# Called from a preStop hook before the node is stopped, returns once drained
+@health_router.post(
+    "/drain", response_model=StatusResponse, dependencies=[Depends(require_admin)]
+)
+async def drain_node(request: Request):
+    result = await drain(request.app)
+    return StatusResponse(status="ok", data=result)
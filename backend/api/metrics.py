@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Request, Response
+
+from misc.metrics import render_metrics
+
+metrics_router = APIRouter(tags=["metrics"])
+
+
+# Prometheus scrape endpoint
+@metrics_router.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    body, content_type = render_metrics(request.app.state.manager)
+    return Response(content=body, media_type=content_type)
@@ -5,6 +5,8 @@ from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_cache.decorator import cache
 
 from database.orm import AsyncORM
+from misc.metrics import BCRYPT_LATENCY
+from misc.profiling import span
 from schemas.users import UserDTO
 from schemas.others import StatusResponse, ConnectTG
 from utils.auth import create_access_token
@@ -31,13 +33,21 @@ async def get_user(user_id: int):
     return user
 
 
+@user_router.get("/{user_id}/presence", response_model=StatusResponse)
+async def get_user_presence(request: Request, user_id: int):
+    presence = request.app.state.presence
+    status = await presence.get_status(user_id)
+    return StatusResponse(status="ok", data=status)
+
+
 @user_router.post("/register/", response_model=StatusResponse)
 async def create_user(
     request: Request, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ):
     try:
         pwd_context = request.app.state.pwd_context
-        hashed_password = pwd_context.hash(form_data.password)
+        with BCRYPT_LATENCY.labels("hash").time(), span("bcrypt.hash"):
+            hashed_password = pwd_context.hash(form_data.password)
         user = await AsyncORM.users.create(
             username=form_data.username, hashed_password=hashed_password
         )
@@ -67,7 +77,9 @@ async def login_for_access_token(
     user = user[0]
 
     pwd_context = request.app.state.pwd_context
-    if not pwd_context.verify(form_data.password, user.hashed_password):
+    with BCRYPT_LATENCY.labels("verify").time(), span("bcrypt.verify"):
+        verified = pwd_context.verify(form_data.password, user.hashed_password)
+    if not verified:
         raise HTTPException(status_code=400, detail="Wrong username or password")
 
     config = request.app.state.config
@@ -48,12 +48,244 @@ class Redis:
 @dataclass
 class Secrets:
     auth: str
+    admin: Optional[str]
 
     @staticmethod
     def from_env(env: Env):
         auth = env.str("AUTH_SECRET")
+        # Token for operational endpoints, they are disabled when it is not set
+        admin = env.str("ADMIN_TOKEN", None)
 
-        return Secrets(auth=auth)
+        return Secrets(auth=auth, admin=admin)
+
+
+@dataclass
+class Presence:
+    ttl: int
+    typing_interval: float
+    offline_grace: float
+
+    @staticmethod
+    def from_env(env: Env):
+        # Seconds a presence key survives without a heartbeat
+        ttl = env.int("PRESENCE_TTL", 60)
+        # At most one typing event per peer per this many seconds
+        typing_interval = env.float("PRESENCE_TYPING_INTERVAL", 1.0)
+        # Delay before broadcasting "offline" so quick reconnects are coalesced
+        offline_grace = env.float("PRESENCE_OFFLINE_GRACE", 5.0)
+
+        return Presence(
+            ttl=ttl, typing_interval=typing_interval, offline_grace=offline_grace
+        )
+
+
+@dataclass
+class Heartbeat:
+    ping_interval: float
+    idle_timeout: float
+    reap_interval: float
+
+    @staticmethod
+    def from_env(env: Env):
+        # Ping a socket that has been silent for this many seconds
+        ping_interval = env.float("WS_PING_INTERVAL", 20.0)
+        # Close a socket that has been silent (no frames, no pongs) this long
+        idle_timeout = env.float("WS_IDLE_TIMEOUT", 60.0)
+        # How often the reaper scans the active connections
+        reap_interval = env.float("WS_REAP_INTERVAL", 10.0)
+
+        return Heartbeat(
+            ping_interval=ping_interval,
+            idle_timeout=idle_timeout,
+            reap_interval=reap_interval,
+        )
+
+
+@dataclass
+class RateLimit:
+    connection_rate: float
+    connection_burst: int
+    user_rate: float
+    user_burst: int
+    max_violations: int
+
+    @staticmethod
+    def from_env(env: Env):
+        # Frames per second a single socket may send (any frame type)
+        connection_rate = env.float("RATE_LIMIT_CONNECTION_RATE", 10.0)
+        connection_burst = env.int("RATE_LIMIT_CONNECTION_BURST", 20)
+        # Chat messages per second a user may send across all sockets and workers
+        user_rate = env.float("RATE_LIMIT_USER_RATE", 5.0)
+        user_burst = env.int("RATE_LIMIT_USER_BURST", 10)
+        # Consecutive rejected frames after which the socket is closed
+        max_violations = env.int("RATE_LIMIT_MAX_VIOLATIONS", 20)
+
+        return RateLimit(
+            connection_rate=connection_rate,
+            connection_burst=connection_burst,
+            user_rate=user_rate,
+            user_burst=user_burst,
+            max_violations=max_violations,
+        )
+
+
+@dataclass
+class Attachments:
+    backend: str
+    storage_dir: str
+    max_size: int
+    chunk_size: int
+    max_message_length: int
+
+    @staticmethod
+    def from_env(env: Env):
+        backend = env.str("ATTACHMENTS_BACKEND", "local")
+        storage_dir = env.str("ATTACHMENTS_DIR", "attachments")
+        # Uploads are aborted as soon as they grow past this many bytes
+        max_size = env.int("ATTACHMENTS_MAX_SIZE", 20 * 1024 * 1024)
+        chunk_size = env.int("ATTACHMENTS_CHUNK_SIZE", 64 * 1024)
+        # Longest text message accepted over the WebSocket, in characters
+        max_message_length = env.int("MAX_MESSAGE_LENGTH", 4096)
+
+        return Attachments(
+            backend=backend,
+            storage_dir=storage_dir,
+            max_size=max_size,
+            chunk_size=chunk_size,
+            max_message_length=max_message_length,
+        )
+
+
+@dataclass
+class Server:
+    workers: int
+    migrations_dir: str
+
+    @staticmethod
+    def from_env(env: Env):
+        workers = env.int("WEB_WORKERS", 1)
+        # Alembic script location, mounted into the backend container
+        migrations_dir = env.str("MIGRATIONS_DIR", "migrations")
+
+        return Server(workers=workers, migrations_dir=migrations_dir)
+
+
+@dataclass
+class Drain:
+    deadline: float
+    reconnect_jitter: float
+
+    @staticmethod
+    def from_env(env: Env):
+        # Seconds to move clients away and flush their messages on shutdown
+        deadline = env.float("DRAIN_DEADLINE", 20.0)
+        # Clients are told to reconnect after a random delay up to this many seconds
+        reconnect_jitter = env.float("DRAIN_RECONNECT_JITTER", 10.0)
+
+        return Drain(deadline=deadline, reconnect_jitter=reconnect_jitter)
+
+
+@dataclass
+class Outbox:
+    delay: float
+    interval: float
+    batch_size: int
+    retry_delay: float
+    reindex_interval: float
+
+    @staticmethod
+    def from_env(env: Env):
+        # Seconds an offline notification waits, later messages are folded into it
+        delay = env.float("OUTBOX_DELAY", 5)
+        # Seconds between relay runs
+        interval = env.float("OUTBOX_INTERVAL", 1)
+        # Conversations relayed per run
+        batch_size = env.int("OUTBOX_BATCH_SIZE", 500)
+        # Seconds before notifications are retried when the broker is unreachable
+        retry_delay = env.float("OUTBOX_RETRY_DELAY", 30)
+        # Seconds between scans for staged notifications missing from the index
+        reindex_interval = env.float("OUTBOX_REINDEX_INTERVAL", 300)
+
+        return Outbox(
+            delay=delay,
+            interval=interval,
+            batch_size=batch_size,
+            retry_delay=retry_delay,
+            reindex_interval=reindex_interval,
+        )
+
+
+@dataclass
+class Cache:
+    ttl: int
+    flush_threshold: int
+    idle_flush: float
+    max_bytes: int
+    janitor_interval: float
+    janitor_batch: int
+    history_size: int
+    catchup_limit: int
+    cursor_ttl: int
+
+    @staticmethod
+    def from_env(env: Env):
+        # Seconds a conversation list lives without being read or written
+        ttl = env.int("CACHE_TTL", 24 * 60 * 60)
+        # Messages cached per conversation before they are written to the database
+        flush_threshold = env.int("CACHE_FLUSH_THRESHOLD", 50)
+        # Conversations idle this long are flushed, must be well below the TTL
+        idle_flush = env.float("CACHE_IDLE_FLUSH", 60 * 60)
+        # Budget for all cached messages, least recently active are flushed first
+        max_bytes = env.int("CACHE_MAX_BYTES", 256 * 1024 * 1024)
+        janitor_interval = env.float("CACHE_JANITOR_INTERVAL", 30)
+        janitor_batch = env.int("CACHE_JANITOR_BATCH", 100)
+        # Latest messages sent on connect, also kept in Redis once persisted
+        history_size = env.int("CACHE_HISTORY_SIZE", 50)
+        # Most messages sent to a device catching up from its cursor
+        catchup_limit = env.int("CACHE_CATCHUP_LIMIT", 500)
+        # Devices not seen for this long get the plain history again
+        cursor_ttl = env.int("CACHE_CURSOR_TTL", 30 * 24 * 60 * 60)
+
+        return Cache(
+            ttl=ttl,
+            flush_threshold=flush_threshold,
+            idle_flush=idle_flush,
+            max_bytes=max_bytes,
+            janitor_interval=janitor_interval,
+            janitor_batch=janitor_batch,
+            history_size=history_size,
+            catchup_limit=catchup_limit,
+            cursor_ttl=cursor_ttl,
+        )
+
+
+@dataclass
+class Profiling:
+    enabled: bool
+    slow_callback: float
+    trace_file: str
+    sample_interval: float
+    max_profile_seconds: float
+
+    @staticmethod
+    def from_env(env: Env):
+        # Opt-in: slow callback logging and tracing spans, both cost time per frame
+        enabled = env.bool("PROFILING_ENABLED", False)
+        # Event loop callbacks running longer than this many seconds are logged
+        slow_callback = env.float("PROFILING_SLOW_CALLBACK", 0.1)
+        # Spans are appended as JSON lines, one file per process
+        trace_file = env.str("PROFILING_TRACE_FILE", "traces/spans.jsonl")
+        # Seconds between stack samples taken by /debug/profile
+        sample_interval = env.float("PROFILING_SAMPLE_INTERVAL", 0.005)
+        max_profile_seconds = env.float("PROFILING_MAX_SECONDS", 60)
+
+        return Profiling(
+            enabled=enabled,
+            slow_callback=slow_callback,
+            trace_file=trace_file,
+            sample_interval=sample_interval,
+            max_profile_seconds=max_profile_seconds,
+        )
 
 
 @dataclass
@@ -61,6 +293,15 @@ class Config:
     postgres: Postgres
     redis: Redis
     secrets: Secrets
+    presence: Presence
+    heartbeat: Heartbeat
+    rate_limit: RateLimit
+    attachments: Attachments
+    server: Server
+    drain: Drain
+    outbox: Outbox
+    cache: Cache
+    profiling: Profiling
 
 
 def load_config(path: Optional[str] = None) -> Config:
@@ -71,4 +312,13 @@ def load_config(path: Optional[str] = None) -> Config:
         postgres=Postgres.from_env(env),
         redis=Redis.from_env(env),
         secrets=Secrets.from_env(env),
+        presence=Presence.from_env(env),
+        heartbeat=Heartbeat.from_env(env),
+        rate_limit=RateLimit.from_env(env),
+        attachments=Attachments.from_env(env),
+        server=Server.from_env(env),
+        drain=Drain.from_env(env),
+        outbox=Outbox.from_env(env),
+        cache=Cache.from_env(env),
+        profiling=Profiling.from_env(env),
     )
@@ -0,0 +1,62 @@
+import asyncio
+
+import asyncpg
+from alembic import command
+from alembic.config import Config as AlembicConfig
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Arbitrary key of the Postgres advisory lock serializing migrations
+MIGRATIONS_LOCK_ID = 7_283_946_001
+
+# Revision matching the schema previously produced by Base.metadata.create_all
+INITIAL_REVISION = "0001"
+
+# Raised while Postgres is unreachable or still starting up, worth retrying.
+# Anything else (a broken revision, a missing script directory) is not
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    OperationalError,
+    InterfaceError,
+)
+
+
+def _upgrade(connection: Connection, script_location: str):
+    alembic_config = AlembicConfig()
+    alembic_config.set_main_option("script_location", script_location)
+    alembic_config.attributes["connection"] = connection
+
+    # Databases created with create_all before migrations existed
+    inspector = inspect(connection)
+    if inspector.has_table("users") and not inspector.has_table("alembic_version"):
+        command.stamp(alembic_config, INITIAL_REVISION)
+
+    command.upgrade(alembic_config, "head")
+
+
+async def run_migrations(engine: AsyncEngine, script_location: str):
+    """
+    Upgrade the schema to the latest revision. Every worker calls this on
+    startup, the advisory lock lets the first one migrate while the others
+    wait and then find nothing to do.
+    """
+    async with engine.connect() as conn:
+        await conn.execute(
+            text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATIONS_LOCK_ID}
+        )
+        try:
+            await conn.run_sync(_upgrade, script_location)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        finally:
+            await conn.execute(
+                text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATIONS_LOCK_ID}
+            )
+            await conn.commit()
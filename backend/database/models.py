@@ -1,6 +1,6 @@
 import datetime
 from typing import Annotated
-from sqlalchemy import ForeignKey, text, BigInteger
+from sqlalchemy import ForeignKey, Index, text, BigInteger, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from .database import Base
 
@@ -28,7 +28,18 @@ class Message(Base):
     sender_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     receiver_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     message: Mapped[str]
+    # Position in the conversation, assigned from a Redis counter on receive
+    seq: Mapped[int] = mapped_column(BigInteger)
     timestamp: Mapped[created_at]
 
     sender = relationship("User", foreign_keys=[sender_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
+
+
+# History is read per conversation, in both directions, ordered by seq
+Index(
+    "ix_messages_conversation_seq",
+    func.least(Message.sender_id, Message.receiver_id),
+    func.greatest(Message.sender_id, Message.receiver_id),
+    Message.seq,
+)
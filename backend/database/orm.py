@@ -1,16 +1,27 @@
-from typing import Generic, List, Type, TypeVar
+from typing import AsyncIterator, Generic, Iterable, List, Type, TypeVar
 
-from sqlalchemy import desc, select
+from sqlalchemy import delete, desc, func, select, update
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import joinedload, sessionmaker
 
 from database.database import Base
 from database.models import Message, User
+from misc.metrics import DB_LATENCY, timed
 from schemas.messages import CachedMessageDTO
 
 T = TypeVar("T", bound=Base)
 
 
+def conversation_filter(sender_id: int, receiver_id: int):
+    """Matches both directions of a conversation, served by ix_messages_conversation_seq"""
+    return (
+        func.least(Message.sender_id, Message.receiver_id)
+        == min(sender_id, receiver_id),
+        func.greatest(Message.sender_id, Message.receiver_id)
+        == max(sender_id, receiver_id),
+    )
+
+
 class CRUD(Generic[T]):
     """
     Generic CRUD class for common database operations
@@ -29,6 +40,7 @@ class CRUD(Generic[T]):
             await session.refresh(obj)
             return obj
 
+    @timed(DB_LATENCY, operation="get")
     async def get(self, id: int) -> T:
         """Retrieve a single instance of the model by its ID"""
         async with self.session_factory() as session:
@@ -39,6 +51,17 @@ class CRUD(Generic[T]):
             except NoResultFound:
                 return None
 
+    @timed(DB_LATENCY, operation="get_many")
+    async def get_many(self, ids: Iterable[int]) -> dict[int, T]:
+        """Retrieve several instances by ID in one query, missing IDs are left out"""
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        async with self.session_factory() as session:
+            query = select(self.model).filter(self.model.id.in_(ids))
+            result = await session.execute(query)
+            return {obj.id: obj for obj in result.scalars()}
+
     async def get_all(self, **kwargs) -> List[T]:
         """Retrieve all instances of the model that match the given filters"""
         async with self.session_factory() as session:
@@ -47,34 +70,60 @@ class CRUD(Generic[T]):
             users = result.scalars().all()
             return users
 
-    async def update(self, id: int, **kwargs) -> T | None:
-        """Update an existing instance of the model with new values"""
+    async def iter_all(self, batch_size: int = 1000, **kwargs) -> AsyncIterator[T]:
+        """
+        Stream all instances of the model that match the given filters through
+        a server-side cursor, only batch_size rows are held in memory at once
+        """
         async with self.session_factory() as session:
-            query = select(self.model).filter_by(id=id)
+            query = (
+                select(self.model)
+                .filter_by(**kwargs)
+                .order_by(self.model.id)
+                .execution_options(yield_per=batch_size)
+            )
+            result = await session.stream_scalars(query)
+            async for obj in result:
+                yield obj
+
+    @timed(DB_LATENCY, operation="update_where")
+    async def update_where(self, filters: dict, **values) -> List[T]:
+        """Update every instance matching the filters in one statement, returns them"""
+        if not filters:
+            raise ValueError("update_where needs at least one filter")
+        # The returned rows are read after the commit, don't expire them
+        async with self.session_factory(expire_on_commit=False) as session:
+            query = (
+                update(self.model)
+                .filter_by(**filters)
+                .values(**values)
+                .returning(self.model)
+            )
             result = await session.execute(query)
-            try:
-                obj = result.scalars().one()
-                for key, value in kwargs.items():
-                    setattr(obj, key, value)
+            objs = result.scalars().all()
+            await session.commit()
+            return objs
+
+    @timed(DB_LATENCY, operation="delete_where")
+    async def delete_where(self, **filters) -> List[T]:
+        """Delete every instance matching the filters in one statement, returns them"""
+        if not filters:
+            raise ValueError("delete_where needs at least one filter")
+        async with self.session_factory(expire_on_commit=False) as session:
+            query = delete(self.model).filter_by(**filters).returning(self.model)
+            result = await session.execute(query)
+            objs = result.scalars().all()
+            await session.commit()
+            return objs
 
-                await session.commit()
-                await session.refresh(obj)
-                return obj
-            except NoResultFound:
-                return None
+    async def update(self, id: int, **kwargs) -> T | None:
+        """Update an existing instance of the model with new values"""
+        updated = await self.update_where({"id": id}, **kwargs)
+        return updated[0] if updated else None
 
     async def delete(self, id: int) -> bool:
         """Delete an instance of the model by its ID"""
-        async with self.session_factory() as session:
-            query = select(self.model).filter_by(id=id)
-            result = await session.execute(query)
-            try:
-                obj = result.scalars().one()
-                await session.delete(obj)
-                await session.commit()
-                return True
-            except NoResultFound:
-                return False
+        return bool(await self.delete_where(id=id))
 
 
 class UsersRepo(CRUD[User]):
@@ -99,25 +148,25 @@ class MessagesRepo(CRUD[Message]):
     def __init__(self, session):
         super().__init__(Message, session)
 
+    @timed(DB_LATENCY, operation="get_chat_history")
     async def get_chat_history(
-        self, sender_id: int, receiver_id: int, limit: int = 50, offset: int = 0
+        self,
+        sender_id: int,
+        receiver_id: int,
+        limit: int = 50,
+        offset: int = 0,
+        after_seq: int = 0,
     ) -> List[Message]:
-        """Retrieve chat history between two users with pagination"""
+        """Retrieve chat history between two users with pagination, newer than after_seq"""
         async with self.session_factory() as session:
             query = (
                 select(Message)
                 .options(joinedload(Message.sender))
                 .filter(
-                    (
-                        (Message.sender_id == sender_id)
-                        & (Message.receiver_id == receiver_id)
-                    )
-                    | (
-                        (Message.sender_id == receiver_id)
-                        & (Message.receiver_id == sender_id)
-                    )
+                    *conversation_filter(sender_id, receiver_id),
+                    Message.seq > after_seq,
                 )
-                .order_by(desc(Message.timestamp))
+                .order_by(desc(Message.seq))
                 .limit(limit)
                 .offset(offset)
             )
@@ -128,6 +177,44 @@ class MessagesRepo(CRUD[Message]):
             except NoResultFound:
                 return []
 
+    async def stream_chat_history(
+        self, sender_id: int, receiver_id: int, batch_size: int = 1000
+    ) -> AsyncIterator[list]:
+        """
+        Stream a whole conversation oldest first through a server-side cursor,
+        batch_size rows at a time, with the sender's username joined in
+        """
+        async with self.session_factory() as session:
+            query = (
+                select(
+                    Message.id,
+                    Message.seq,
+                    Message.sender_id,
+                    User.username.label("sender_username"),
+                    Message.receiver_id,
+                    Message.message,
+                    Message.timestamp,
+                )
+                .join(User, User.id == Message.sender_id)
+                .filter(*conversation_filter(sender_id, receiver_id))
+                .order_by(Message.seq)
+                .execution_options(yield_per=batch_size)
+            )
+            result = await session.stream(query)
+            async for rows in result.partitions():
+                yield rows
+
+    @timed(DB_LATENCY, operation="get_last_seq")
+    async def get_last_seq(self, sender_id: int, receiver_id: int) -> int:
+        """Highest sequence number persisted for a conversation, 0 if none"""
+        async with self.session_factory() as session:
+            query = select(func.max(Message.seq)).filter(
+                *conversation_filter(sender_id, receiver_id)
+            )
+            result = await session.execute(query)
+            return result.scalar() or 0
+
+    @timed(DB_LATENCY, operation="add_cached_messages")
     async def add_cached_messages(self, messages: List[CachedMessageDTO]):
         """Add a list of cached messages to the database"""
         async with self.session_factory() as session:
@@ -136,7 +223,11 @@ class MessagesRepo(CRUD[Message]):
                     sender_id=message.sender_id,
                     receiver_id=message.receiver_id,
                     message=message.message,
+                    seq=message.seq,
                 )
+                # Keep the receive time, messages cached before it was recorded get now()
+                if message.timestamp is not None:
+                    obj.timestamp = message.timestamp
                 session.add(obj)
 
             await session.commit()
@@ -159,8 +250,3 @@ class AsyncORM:
     def init_models(cls):
         cls.users = UsersRepo(cls.session_factory)
         cls.messages = MessagesRepo(cls.session_factory)
-
-    @classmethod
-    async def create_tables(cls, engine):
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
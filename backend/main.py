@@ -4,6 +4,7 @@ from contextlib import asynccontextmanager
 
 import redis.asyncio as aioredis
 import uvicorn
+from uvicorn.supervisors import Multiprocess
 from celery import Celery
 from fastapi import FastAPI
 from fastapi_cache import FastAPICache
@@ -12,31 +13,61 @@ from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
 from api import routers_list
 from config import load_config
+from database.migrations import CONNECTION_ERRORS, run_migrations
 from database.orm import AsyncORM
+from misc.connection_manager import ConnectionManager
+from misc.metrics import instrument_engine
+from misc.presence import PresenceManager
+from misc.profiling import (
+    install_slow_callback_logging,
+    setup_tracing,
+    trace_engine,
+)
+from misc.rate_limiter import RateLimiter
+from misc.server import DrainingServer
+from misc.storage import get_storage
+from misc.task_dispatcher import TaskDispatcher
+from utils.cache import migrate_legacy_cache, run_cache_janitor
+from utils.drain import drain
+from utils.outbox import run_outbox_relay
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 
 
 async def setup_database(config):
-    """Establishes a connection to the PostgreSQL database and initializes the ORM"""
+    """Creates the engine and initializes the ORM, no connection is opened yet"""
+    async_engine = create_async_engine(
+        url=f"postgresql+asyncpg://{config.postgres.db_user}:{config.postgres.db_pass}"
+        f"@{config.postgres.db_host}:5432/{config.postgres.db_name}",
+        # echo=True,
+    )
+    instrument_engine(async_engine.sync_engine)
+    trace_engine(async_engine.sync_engine)
+    async_session_factory = async_sessionmaker(async_engine)
+    AsyncORM.set_session_factory(async_session_factory)
+    AsyncORM.init_models()
+    return async_engine
+
+
+async def migrate_database(app: FastAPI, config, async_engine):
+    """Waits for PostgreSQL, applies migrations and marks the database as ready"""
     while True:
         try:
-            async_engine = create_async_engine(
-                url=f"postgresql+asyncpg://{config.postgres.db_user}:{config.postgres.db_pass}"
-                f"@{config.postgres.db_host}:5432/{config.postgres.db_name}",
-                # echo=True,
-            )
-            async_session_factory = async_sessionmaker(async_engine)
-            AsyncORM.set_session_factory(async_session_factory)
-            AsyncORM.init_models()
-            await AsyncORM.create_tables(async_engine)
-
+            await run_migrations(async_engine, config.server.migrations_dir)
             break
-        except Exception:
+        except CONNECTION_ERRORS:
+            logging.warning("Database is not ready, retrying", exc_info=True)
             await asyncio.sleep(1)
+        except Exception:
+            # Retrying won't help, /health/ready keeps reporting 503
+            logging.exception("Database migrations failed")
+            return
 
+    app.state.db_ready = True
     logging.info("Successfully connected to Database")
 
+    await migrate_legacy_cache(app.state.redis, config.cache)
+
 
 async def setup_redis(config):
     """Establishes a connection to the Redis server for caching"""
@@ -50,25 +81,31 @@ async def setup_celery(config):
     celery_app = Celery(
         "chat_tasks",
         broker=f"redis://:{config.redis.redis_pass}@{config.redis.redis_host}:{config.redis.redis_port}/1",
-        backend=f"redis://:{config.redis.redis_pass}@{config.redis.redis_host}:{config.redis.redis_port}/0",
     )
 
+    # Tasks are fire-and-forget, nobody reads their results
     celery_app.conf.update(
         task_serializer="json",
         accept_content=["json"],
-        result_serializer="json",
+        task_ignore_result=True,
         timezone="UTC",
         enable_utc=True,
     )
     return celery_app
 
 
+config = load_config(".env")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    config = load_config(".env")
+    if config.profiling.enabled:
+        install_slow_callback_logging(config.profiling.slow_callback)
+
+    app.state.db_ready = False
+    app.state.engine = await setup_database(config)
 
-    await setup_database(config)
     redis = await setup_redis(config)
     celery_app = await setup_celery(config)
 
@@ -78,19 +115,80 @@ async def lifespan(app: FastAPI):
 
     app.state.redis = redis
     app.state.celery = celery_app
+    # Don't block on Postgres, /health/ready reports when the schema is in place
+    migrations = asyncio.create_task(
+        migrate_database(app, config, app.state.engine)
+    )
+    app.state.dispatcher = TaskDispatcher(celery_app)
     app.state.config = config
 
-    for router in routers_list:
-        app.include_router(router)
+    # Live connections and presence
+    app.state.manager = ConnectionManager()
+    app.state.presence = PresenceManager(redis, app.state.manager, config.presence)
+    app.state.rate_limiter = RateLimiter(redis, config.rate_limit)
+    app.state.storage = get_storage(config.attachments)
+    reaper = asyncio.create_task(
+        app.state.manager.run_reaper(
+            config.heartbeat, app.state.presence.user_disconnected
+        )
+    )
+    janitor = asyncio.create_task(run_cache_janitor(redis, config.cache))
+    relay = asyncio.create_task(
+        run_outbox_relay(redis, app.state.dispatcher, config.outbox)
+    )
 
     yield
 
     # Shutdown
-    await FastAPICache.clear()
-    await AsyncORM.session_factory().close()
+    # Staged notifications stay in Redis, another node or the next start relays them
+    relay.cancel()
+    # Usually already done on SIGTERM or by POST /health/drain, the cache is
+    # shared with other nodes so it is flushed per conversation rather than cleared
+    await drain(app)
+    await app.state.dispatcher.close()
+
+    migrations.cancel()
+    reaper.cancel()
+    janitor.cancel()
+    await app.state.presence.close()
+    await redis.aclose()
+    await app.state.engine.dispose()
+
+
+app = FastAPI(title="API Example", lifespan=lifespan)
+
+for router in routers_list:
+    app.include_router(router)
+
+# Must wrap the app before it starts, middleware can't be added later
+if config.profiling.enabled:
+    setup_tracing(app, config.profiling)
 
 
 if __name__ == "__main__":
-    app = FastAPI(title="API Example", lifespan=lifespan)
+    heartbeat = config.heartbeat
+
+    # Protocol-level pings let uvicorn notice half-open TCP connections,
+    # application-level pings and the reaper handle idle clients
+    server_config = uvicorn.Config(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=config.server.workers,
+        ws_ping_interval=heartbeat.ping_interval,
+        ws_ping_timeout=heartbeat.ping_interval,
+        # Large payloads go through /attachments, keep frames small
+        ws_max_size=config.attachments.max_message_length * 4 + 1024,
+        timeout_graceful_shutdown=int(config.drain.deadline) + 5,
+        # Slow callback logging hooks the pure Python loop, not uvloop
+        loop="asyncio" if config.profiling.enabled else "auto",
+    )
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Drains the sockets on SIGTERM, before uvicorn closes them
+    server = DrainingServer(server_config, before_exit=drain)
+    if server_config.workers > 1:
+        Multiprocess(
+            server_config, target=server.run, sockets=[server_config.bind_socket()]
+        ).run()
+    else:
+        server.run()
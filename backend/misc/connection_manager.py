@@ -1,27 +1,268 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
 from fastapi import WebSocket
 
+from config import Drain, Heartbeat
+from misc.metrics import (
+    ACTIVE_CONNECTIONS,
+    CONNECTIONS_OPENED,
+    CONNECTIONS_REAPED,
+    SEND_LATENCY,
+)
+from misc.profiling import span
+
+
+class Connection:
+    """A single WebSocket session opened by a user to chat with a peer"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        peer_id: int,
+        device_id: str | None = None,
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.peer_id = peer_id
+        # Sent by clients that keep their history, anonymous sessions have none
+        self.device_id = device_id
+        self.last_activity = time.monotonic()
+        # Sends started but not yet completed, grows when the client is slow
+        self.pending_sends = 0
+
+    def touch(self):
+        """Record that a frame was received from the client"""
+        self.last_activity = time.monotonic()
+
+    def idle_for(self) -> float:
+        return time.monotonic() - self.last_activity
+
+    async def send_text(self, message: str):
+        self.pending_sends += 1
+        try:
+            await self.websocket.send_text(message)
+        finally:
+            self.pending_sends -= 1
+
+    async def send_json(self, payload: dict):
+        """Send a control event (presence, typing, ...) as a JSON text frame"""
+        await self.send_text(json.dumps(payload))
+
+    @property
+    def session_key(self):
+        """
+        A device reconnecting to the same conversation replaces its previous
+        session, its sockets for other conversations stay open
+        """
+        return (self.device_id, self.peer_id) if self.device_id is not None else id(self)
+
 
 class ConnectionManager:
     """Manages WebSocket connections for real-time communication"""
 
     def __init__(self):
-        """Dictionary to keep track of active connections"""
-        self.active_connections: dict[int, WebSocket] = {}
+        """Dictionary to keep track of active connections, per user and device"""
+        self.active_connections: dict[int, dict[tuple[str, int] | int, Connection]] = {}
+        # Index of connections by the user they are chatting with
+        self._by_peer: dict[int, set[Connection]] = {}
+        # Set when the node is shutting down, new sockets are refused
+        self.draining = False
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        """Accept a new WebSocket connection and store it"""
+    async def connect(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        peer_id: int,
+        device_id: str | None = None,
+    ):
+        """Accept a new WebSocket connection and store it next to the user's other devices"""
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        connection = Connection(websocket, user_id, peer_id, device_id)
+
+        devices = self.active_connections.setdefault(user_id, {})
+        previous = devices.get(connection.session_key)
+        if previous:
+            self._unindex(previous)
+        else:
+            ACTIVE_CONNECTIONS.inc()
+        CONNECTIONS_OPENED.inc()
+
+        devices[connection.session_key] = connection
+        self._by_peer.setdefault(peer_id, set()).add(connection)
 
-    def disconnect(self, user_id: int):
+        if previous:
+            # Unregistered above, left open it would never get a message or be reaped
+            try:
+                await self._close(previous, code=1000, reason="Replaced by a new session")
+            except Exception:
+                pass
+        return connection
+
+    def disconnect(self, connection: Connection):
         """Remove a WebSocket connection from the active connections"""
-        self.active_connections.pop(user_id, None)
+        devices = self.active_connections.get(connection.user_id, {})
+        # A newer session of the same device may have replaced this one
+        if devices.get(connection.session_key) is connection:
+            devices.pop(connection.session_key)
+            if not devices:
+                self.active_connections.pop(connection.user_id)
+            self._unindex(connection)
+            ACTIVE_CONNECTIONS.dec()
 
-    async def send_personal_message(self, message: str, receiver_id: int):
-        """Send a personal message to a specific user"""
-        receiver_ws = self.active_connections.get(receiver_id)
-        if not receiver_ws:
-            return False
+    def _unindex(self, connection: Connection):
+        peers = self._by_peer.get(connection.peer_id)
+        if peers is not None:
+            peers.discard(connection)
+            if not peers:
+                self._by_peer.pop(connection.peer_id)
+
+    def is_connected(self, user_id: int) -> bool:
+        return user_id in self.active_connections
+
+    def connections(self) -> list[Connection]:
+        """Every open connection, all devices of all users"""
+        return [
+            connection
+            for devices in self.active_connections.values()
+            for connection in devices.values()
+        ]
+
+    def devices_of(self, user_id: int) -> list[Connection]:
+        return list(self.active_connections.get(user_id, {}).values())
+
+    def peers_of(self, user_id: int) -> list[Connection]:
+        """Connections whose open conversation is with the given user"""
+        return list(self._by_peer.get(user_id, ()))
 
-        await receiver_ws.send_text(message)
+    async def broadcast_json(self, connections: list[Connection], payload: dict):
+        """Send the same control event to several connections concurrently"""
+        await asyncio.gather(
+            *(connection.send_json(payload) for connection in connections),
+            return_exceptions=True,
+        )
+
+    async def _send(self, connection: Connection, message: str) -> bool:
+        try:
+            with SEND_LATENCY.time(), span("ws.send", user_id=connection.user_id):
+                await connection.send_text(message)
+        except Exception:
+            # The socket is dead, forget it
+            self.disconnect(connection)
+            return False
         return True
+
+    async def send_many(
+        self, connections: list[Connection], message: str
+    ) -> list[Connection]:
+        """Send a message to several connections concurrently, returns the ones reached"""
+        results = await asyncio.gather(
+            *(self._send(connection, message) for connection in connections)
+        )
+        return [connection for connection, sent in zip(connections, results) if sent]
+
+    async def reap(self, config: Heartbeat) -> list[Connection]:
+        """Ping quiet connections and close the ones idle past the timeout"""
+        stale, quiet = [], []
+        for connection in self.connections():
+            idle = connection.idle_for()
+            if idle >= config.idle_timeout:
+                stale.append(connection)
+            elif idle >= config.ping_interval:
+                quiet.append(connection)
+
+        for connection in stale:
+            self.disconnect(connection)
+
+        await asyncio.gather(
+            *(connection.send_json({"type": "ping"}) for connection in quiet),
+            *(self._close(connection, code=1001) for connection in stale),
+            return_exceptions=True,
+        )
+
+        CONNECTIONS_REAPED.inc(len(stale))
+        return stale
+
+    async def run_reaper(
+        self,
+        config: Heartbeat,
+        on_reaped: Callable[[int], Awaitable[None]],
+    ):
+        """Periodically reap stale connections until cancelled"""
+        while True:
+            await asyncio.sleep(config.reap_interval)
+            try:
+                stale = await self.reap(config)
+                for connection in stale:
+                    await on_reaped(connection.user_id)
+                if stale:
+                    logging.info(f"Reaped {len(stale)} stale connections")
+            except Exception:
+                logging.exception("Connection reaper failed")
+
+    def conversations(self) -> set[tuple[int, int]]:
+        """(user, peer) pairs with an open socket on this node"""
+        return {
+            (connection.user_id, connection.peer_id)
+            for connection in self.connections()
+        }
+
+    async def drain(self, config: Drain) -> int:
+        """
+        Refuse new sockets and close the open ones with 1012 (service restart).
+        Each client gets its own random retry delay so they don't all
+        reconnect to the remaining nodes at the same moment.
+        """
+        self.draining = True
+        connections = self.connections()
+
+        async def move(connection: Connection):
+            retry_after = self.retry_after(config)
+            self.disconnect(connection)
+            await connection.send_json({"type": "reconnect", "retry_after": retry_after})
+            await self._close(
+                connection,
+                code=1012,
+                reason=json.dumps({"retry_after": retry_after}),
+            )
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    *(move(connection) for connection in connections),
+                    return_exceptions=True,
+                ),
+                timeout=config.deadline,
+            )
+        except asyncio.TimeoutError:
+            logging.warning("Drain deadline reached before all sockets closed")
+
+        return len(connections)
+
+    async def refuse(self, websocket: WebSocket, config: Drain):
+        """
+        Turn away a socket while draining. The handshake is completed first:
+        a close before accept is an HTTP 403 that browsers report as 1006,
+        the client needs 1013 and its retry delay to reconnect elsewhere.
+        """
+        await websocket.accept()
+        await websocket.close(
+            code=1013, reason=json.dumps({"retry_after": self.retry_after(config)})
+        )
+
+    @staticmethod
+    def retry_after(config: Drain) -> float:
+        """Random reconnect delay, spreads clients over time"""
+        return round(random.uniform(0, config.reconnect_jitter), 1)
+
+    @staticmethod
+    async def _close(connection: Connection, code: int, reason: str | None = None):
+        # A half-open socket may never complete the close handshake
+        await asyncio.wait_for(
+            connection.websocket.close(code=code, reason=reason), timeout=5
+        )
@@ -0,0 +1,165 @@
+import functools
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Buckets tuned for in-datacenter calls: 0.5ms .. 2.5s
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+# Connections
+ACTIVE_CONNECTIONS = Gauge(
+    "chat_active_connections",
+    "WebSocket connections registered in the connection manager",
+    multiprocess_mode="livesum",
+)
+SEND_QUEUE_DEPTH = Gauge(
+    "chat_send_queue_depth",
+    "Sends awaiting completion on sockets, summed and worst socket",
+    ["stat"],
+    multiprocess_mode="livemax",
+)
+CONNECTIONS_OPENED = Counter(
+    "chat_connections_opened_total", "WebSocket connections accepted"
+)
+CONNECTIONS_REAPED = Counter(
+    "chat_connections_reaped_total", "Stale WebSocket connections closed by the reaper"
+)
+FRAMES_REJECTED = Counter(
+    "chat_frames_rejected_total", "Frames dropped by rate limits", ["scope"]
+)
+
+# Messages
+MESSAGES_RECEIVED = Counter("chat_messages_received_total", "Chat messages received")
+MESSAGES_DELIVERED = Counter(
+    "chat_messages_delivered_total", "Chat messages delivered over a live socket"
+)
+SEND_LATENCY = Histogram(
+    "chat_send_personal_message_seconds",
+    "Time to push a message to the receiver socket",
+    buckets=LATENCY_BUCKETS,
+)
+
+# Storage
+DB_LATENCY = Histogram(
+    "chat_db_operation_seconds",
+    "Latency of repository operations",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES = Histogram(
+    "chat_db_query_seconds",
+    "Latency of individual SQL statements",
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_LATENCY = Histogram(
+    "chat_cache_operation_seconds",
+    "Latency of Redis message cache operations",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_BYTES = Gauge(
+    "chat_cache_bytes",
+    "Size of all cached messages, as tracked by the cache janitor",
+    multiprocess_mode="liveall",
+)
+CACHE_EVICTIONS = Counter(
+    "chat_cache_evictions_total",
+    "Conversations flushed from the cache by the janitor",
+    ["reason"],
+)
+CACHE_FLUSH_LATENCY = Histogram(
+    "chat_cache_flush_seconds",
+    "Time to move a full conversation cache into the database",
+    buckets=LATENCY_BUCKETS,
+)
+
+# Other hot paths
+BCRYPT_LATENCY = Histogram(
+    "chat_bcrypt_seconds",
+    "Password hashing and verification time (blocks the event loop)",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+CELERY_DISPATCH_LATENCY = Histogram(
+    "chat_celery_dispatch_seconds",
+    "Time to publish a batch of tasks to the Celery broker",
+    buckets=LATENCY_BUCKETS,
+)
+CELERY_TASKS_PUBLISHED = Counter(
+    "chat_celery_tasks_published_total", "Tasks published to the Celery broker"
+)
+NOTIFICATIONS_RELAYED = Counter(
+    "chat_notifications_relayed_total",
+    "Offline notifications published from the outbox",
+)
+NOTIFICATIONS_COALESCED = Counter(
+    "chat_notifications_coalesced_total",
+    "Offline messages folded into another notification of the same sender",
+)
+
+LOOP_SLOW_CALLBACKS = Histogram(
+    "chat_loop_slow_callback_seconds",
+    "Event loop callbacks over PROFILING_SLOW_CALLBACK, only when profiling is enabled",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+
+def timed(histogram: Histogram, **labels):
+    """Decorator observing the duration of an async function"""
+
+    def decorator(func):
+        metric = histogram.labels(**labels) if labels else histogram
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_engine(engine: Engine):
+    """Observe every SQL statement executed through the engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.observe(time.perf_counter() - conn.info["query_start"].pop())
+
+
+def render_metrics(manager) -> tuple[bytes, str]:
+    """Refresh scrape-time gauges and serialize all metrics"""
+    connections = manager.connections()
+    depths = [connection.pending_sends for connection in connections]
+
+    SEND_QUEUE_DEPTH.labels("total").set(sum(depths))
+    SEND_QUEUE_DEPTH.labels("max").set(max(depths, default=0))
+
+    # With several workers every process writes to PROMETHEUS_MULTIPROC_DIR
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    return generate_latest(), CONTENT_TYPE_LATEST
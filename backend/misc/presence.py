@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+from redis.asyncio.client import Redis
+
+from config import Presence
+from misc.connection_manager import Connection, ConnectionManager
+
+
+def get_presence_key(user_id: int):
+    """Key that exists (with a TTL) while the user is online"""
+    return f"presence:{user_id}"
+
+
+def get_last_seen_key(user_id: int):
+    """Key holding the unix timestamp the user was last active at"""
+    return f"last_seen:{user_id}"
+
+
+class PresenceManager:
+    """
+    Tracks online state in Redis and delivers presence and typing events to
+    conversation peers. Events are coalesced: typing is throttled per peer,
+    heartbeats refresh Redis at most a few times per TTL, and "offline" is
+    delayed by a grace period so reconnects don't produce offline/online pairs.
+    """
+
+    def __init__(self, redis_client: Redis, manager: ConnectionManager, config: Presence):
+        self.redis = redis_client
+        self.manager = manager
+        self.config = config
+
+        self._typing_sent: dict[tuple[int, int], float] = {}
+        self._refreshed: dict[int, float] = {}
+        self._pending_offline: dict[int, asyncio.Task] = {}
+        # Users whose peers were already told they are online
+        self._announced: set[int] = set()
+
+    async def user_connected(self, connection: Connection):
+        """Mark the user online and tell both sides of the conversation"""
+        user_id = connection.user_id
+
+        pending = self._pending_offline.pop(user_id, None)
+        if pending:
+            # Reconnected within the grace period, peers never saw "offline"
+            pending.cancel()
+
+        await self._refresh(user_id, force=True)
+        # Only the first socket announces the user, extra devices and
+        # reconnects within the grace period don't
+        if user_id not in self._announced:
+            self._announced.add(user_id)
+            await self._broadcast(user_id, "online")
+
+        await connection.send_json(await self.get_status(connection.peer_id))
+
+    async def user_disconnected(self, user_id: int):
+        """Schedule the "offline" broadcast unless the user is still connected"""
+        if self.manager.is_connected(user_id) or user_id in self._pending_offline:
+            return
+
+        self._pending_offline[user_id] = asyncio.create_task(
+            self._offline_after_grace(user_id)
+        )
+
+    async def heartbeat(self, user_id: int):
+        """Keep the presence key alive, touching Redis only when needed"""
+        await self._refresh(user_id)
+
+    async def typing(self, user_id: int, peer_id: int):
+        """Forward a typing event to the peer, at most once per interval"""
+        now = time.monotonic()
+        last = self._typing_sent.get((user_id, peer_id))
+        if last is not None and now - last < self.config.typing_interval:
+            return
+
+        self._typing_sent[(user_id, peer_id)] = now
+        connections = [
+            connection
+            for connection in self.manager.peers_of(user_id)
+            if connection.user_id == peer_id
+        ]
+        await self.manager.broadcast_json(
+            connections, {"type": "typing", "user_id": user_id}
+        )
+
+    async def get_status(self, user_id: int) -> dict:
+        """Current presence of a user as a ready-to-send event"""
+        online, last_seen = await asyncio.gather(
+            self.redis.exists(get_presence_key(user_id)),
+            self.redis.get(get_last_seen_key(user_id)),
+        )
+        return {
+            "type": "presence",
+            "user_id": user_id,
+            "status": "online" if online else "offline",
+            "last_seen": int(last_seen) if last_seen else None,
+        }
+
+    async def close(self):
+        """Cancel pending offline broadcasts on shutdown"""
+        for task in self._pending_offline.values():
+            task.cancel()
+        self._pending_offline.clear()
+
+    async def _refresh(self, user_id: int, force: bool = False):
+        now = time.monotonic()
+        last = self._refreshed.get(user_id)
+        if not force and last is not None and now - last < self.config.ttl / 3:
+            return
+
+        self._refreshed[user_id] = now
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(get_presence_key(user_id), 1, ex=self.config.ttl)
+            pipe.set(get_last_seen_key(user_id), int(time.time()))
+            await pipe.execute()
+
+    async def _offline_after_grace(self, user_id: int):
+        try:
+            await asyncio.sleep(self.config.offline_grace)
+        except asyncio.CancelledError:
+            return
+
+        self._pending_offline.pop(user_id, None)
+        if self.manager.is_connected(user_id):
+            return
+
+        self._refreshed.pop(user_id, None)
+        self._announced.discard(user_id)
+        for key in [key for key in self._typing_sent if user_id in key]:
+            self._typing_sent.pop(key)
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(get_presence_key(user_id))
+            pipe.set(get_last_seen_key(user_id), int(time.time()))
+            await pipe.execute()
+
+        await self._broadcast(user_id, "offline")
+
+    async def _broadcast(self, user_id: int, status: str):
+        await self.manager.broadcast_json(
+            self.manager.peers_of(user_id),
+            {
+                "type": "presence",
+                "user_id": user_id,
+                "status": status,
+                "last_seen": int(time.time()),
+            },
+        )
@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+from config import Profiling
+from misc.metrics import LOOP_SLOW_CALLBACKS
+
+# Set by setup_tracing, spans are no-ops until then
+_tracer = None
+
+
+def span(name: str, **attributes):
+    """Context manager tracing a block, does nothing unless tracing is enabled"""
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def install_slow_callback_logging(threshold: float):
+    """
+    Times every callback the asyncio event loop runs and logs the ones
+    taking longer than threshold seconds. Cheaper than loop debug mode,
+    which also tracks coroutine origins. Not effective under uvloop.
+    """
+    original_run = asyncio.events.Handle._run
+    if getattr(original_run, "slow_callback_threshold", None) is not None:
+        return
+
+    def _run(handle):
+        started = time.perf_counter()
+        try:
+            return original_run(handle)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed >= threshold:
+                LOOP_SLOW_CALLBACKS.observe(elapsed)
+                logging.warning(
+                    f"Event loop blocked for {elapsed * 1000:.1f} ms by {handle!r}"
+                )
+
+    _run.slow_callback_threshold = threshold
+    asyncio.events.Handle._run = _run
+
+
+def _trace_path(config: Profiling) -> str:
+    # Workers are separate processes, each gets its own file
+    root, ext = os.path.splitext(config.trace_file)
+    path = f"{root}.{os.getpid()}{ext}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+def setup_tracing(app, config: Profiling):
+    """
+    Exports OpenTelemetry spans to a local JSON lines file: HTTP requests and
+    WebSocket sessions, Redis commands, SQL statements and Celery publishes,
+    plus the spans opened with span(). Engines are added with trace_engine.
+    """
+    global _tracer
+
+    from opentelemetry import trace
+    from opentelemetry.instrumentation.celery import CeleryInstrumentor
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    from opentelemetry.instrumentation.redis import RedisInstrumentor
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "chat-backend"}))
+    exporter = ConsoleSpanExporter(
+        out=open(_trace_path(config), "a", buffering=1),
+        formatter=lambda span: span.to_json(indent=None) + "\n",
+    )
+    # Exported from a background thread, the event loop only queues spans
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+    FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics,health/live")
+    RedisInstrumentor().instrument()
+    CeleryInstrumentor().instrument()
+
+    _tracer = trace.get_tracer("chat")
+
+
+def trace_engine(engine):
+    """Traces the SQL statements of an engine, if tracing is enabled"""
+    if _tracer is None:
+        return
+    from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
+
+    SQLAlchemyInstrumentor().instrument(engine=engine)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval from a background
+    thread. Meant for the event loop thread: the hottest stacks are the code
+    that keeps the loop busy, including calls that block it.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+
+    @staticmethod
+    def _fold(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+            )
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def run(self, duration: float) -> collections.Counter:
+        """Blocks for duration seconds, returns sample counts per folded stack"""
+        samples = collections.Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                samples[self._fold(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        return samples
+
+
+def format_folded(samples: collections.Counter) -> str:
+    """Folded stacks, one per line, the input format of flamegraph tools"""
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
@@ -0,0 +1,95 @@
+import time
+
+from redis.asyncio.client import Redis
+
+from config import RateLimit
+from misc.metrics import FRAMES_REJECTED
+
+# Token bucket kept in a Redis hash. Uses the server clock so that every
+# worker refills the bucket the same way.
+# KEYS[1] - bucket key, ARGV - rate (tokens/s), burst, cost
+# Returns {allowed (0/1), seconds until enough tokens as a string}
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+
+return {allowed, tostring(retry_after)}
+"""
+
+
+def get_rate_limit_key(user_id: int):
+    """Generates a key for the per-user token bucket"""
+    return f"ratelimit:user:{user_id}"
+
+
+class TokenBucket:
+    """In-process token bucket, used to limit a single connection"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def consume(self, cost: float = 1) -> float:
+        """Take tokens from the bucket, returns 0 on success or seconds to wait"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Per-connection (local) and per-user (Redis, shared by all workers) limits"""
+
+    def __init__(self, redis_client: Redis, config: RateLimit):
+        self.redis = redis_client
+        self.config = config
+        self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def connection_bucket(self) -> TokenBucket:
+        return TokenBucket(self.config.connection_rate, self.config.connection_burst)
+
+    def check_connection(self, bucket: TokenBucket) -> float:
+        """Cheap local check applied to every frame"""
+        retry_after = bucket.consume()
+        if retry_after:
+            FRAMES_REJECTED.labels("connection").inc()
+        return retry_after
+
+    async def check_user(self, user_id: int) -> float:
+        """Global check applied to frames that hit the database and the task queue"""
+        allowed, retry_after = await self._script(
+            keys=[get_rate_limit_key(user_id)],
+            args=[self.config.user_rate, self.config.user_burst, 1],
+        )
+        if int(allowed):
+            return 0
+        FRAMES_REJECTED.labels("user").inc()
+        return float(retry_after)
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    On SIGTERM uvicorn closes every WebSocket with a bare 1012 before the
+    lifespan shutdown runs. This server awaits before_exit(app) first, while
+    the sockets are still open, and only then lets uvicorn shut down.
+    """
+
+    def __init__(
+        self,
+        config: uvicorn.Config,
+        before_exit: Callable[[Any], Awaitable[Any]],
+    ):
+        super().__init__(config)
+        # A module-level function, the server is pickled into worker processes
+        self.before_exit = before_exit
+        self._exiting: asyncio.Task | None = None
+
+    def handle_exit(self, sig, frame):
+        # Not started yet, or a second signal: exit right away
+        if not self.started or self._exiting is not None:
+            return super().handle_exit(sig, frame)
+        self._exiting = asyncio.get_running_loop().create_task(
+            self._exit_after_drain(sig, frame)
+        )
+
+    async def _exit_after_drain(self, sig, frame):
+        # The app uvicorn loaded in this process, not a copy from __main__
+        app = self.config.app
+        if isinstance(app, str):
+            app = import_from_string(app)
+        try:
+            await self.before_exit(app)
+        except Exception:
+            logging.exception("Drain before exit failed")
+        finally:
+            super().handle_exit(sig, frame)
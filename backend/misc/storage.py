@@ -0,0 +1,123 @@
+import hashlib
+import os
+import re
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from starlette.concurrency import run_in_threadpool
+
+from config import Attachments
+
+ATTACHMENT_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class AttachmentTooLarge(Exception):
+    """Raised while streaming an upload that exceeds the size limit"""
+
+
+@dataclass
+class StoredAttachment:
+    id: str
+    size: int
+    deduplicated: bool
+
+
+def is_attachment_id(value: str) -> bool:
+    """Attachment ids are SHA-256 hex digests of the content"""
+    return bool(ATTACHMENT_ID_RE.match(value))
+
+
+def format_attachment_reference(attachment_id: str, name: str) -> str:
+    """The small reference stored in a chat message instead of the content"""
+    return f"[attachment:{attachment_id}] {name}"
+
+
+class AttachmentStorage(ABC):
+    """Content-addressed storage for attachments, ids are SHA-256 of the content"""
+
+    @abstractmethod
+    async def save(
+        self, chunks: AsyncIterator[bytes], max_size: int
+    ) -> StoredAttachment:
+        """Store a stream of chunks, raising AttachmentTooLarge past max_size"""
+
+    @abstractmethod
+    async def exists(self, attachment_id: str) -> bool:
+        """Check whether an attachment is stored"""
+
+    @abstractmethod
+    def read(self, attachment_id: str) -> AsyncIterator[bytes]:
+        """Stream an attachment back in chunks"""
+
+
+class LocalStorage(AttachmentStorage):
+    """Stores attachments on the local filesystem under <root>/ab/cd/<id>"""
+
+    def __init__(self, root: str, chunk_size: int):
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def _path(self, attachment_id: str) -> str:
+        return os.path.join(
+            self.root, attachment_id[:2], attachment_id[2:4], attachment_id
+        )
+
+    async def save(
+        self, chunks: AsyncIterator[bytes], max_size: int
+    ) -> StoredAttachment:
+        tmp_path = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+
+        tmp_file = await run_in_threadpool(open, tmp_path, "wb")
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise AttachmentTooLarge()
+                digest.update(chunk)
+                await run_in_threadpool(tmp_file.write, chunk)
+        except BaseException:
+            await run_in_threadpool(tmp_file.close)
+            await run_in_threadpool(os.remove, tmp_path)
+            raise
+        await run_in_threadpool(tmp_file.close)
+
+        attachment_id = digest.hexdigest()
+        path = self._path(attachment_id)
+
+        # Same content was uploaded before, keep the existing copy
+        if await run_in_threadpool(os.path.exists, path):
+            await run_in_threadpool(os.remove, tmp_path)
+            return StoredAttachment(id=attachment_id, size=size, deduplicated=True)
+
+        await run_in_threadpool(os.makedirs, os.path.dirname(path), exist_ok=True)
+        await run_in_threadpool(os.replace, tmp_path, path)
+        return StoredAttachment(id=attachment_id, size=size, deduplicated=False)
+
+    async def exists(self, attachment_id: str) -> bool:
+        return await run_in_threadpool(os.path.exists, self._path(attachment_id))
+
+    async def read(self, attachment_id: str) -> AsyncIterator[bytes]:
+        file = await run_in_threadpool(open, self._path(attachment_id), "rb")
+        try:
+            while chunk := await run_in_threadpool(file.read, self.chunk_size):
+                yield chunk
+        finally:
+            await run_in_threadpool(file.close)
+
+
+storage_backends = {
+    "local": lambda config: LocalStorage(config.storage_dir, config.chunk_size),
+}
+
+
+def get_storage(config: Attachments) -> AttachmentStorage:
+    """Build the storage backend selected in the config"""
+    try:
+        return storage_backends[config.backend](config)
+    except KeyError:
+        raise ValueError(f"Unknown attachments backend: {config.backend}")
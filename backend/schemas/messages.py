@@ -17,6 +17,7 @@ class MessageCreateDTO(MessageBaseDTO):
 class MessageInDBBaseDTO(MessageBaseDTO):
     model_config = ConfigDict(from_attributes=True)
     id: int
+    seq: int
     timestamp: datetime
     sender: UserDTO
 
@@ -24,6 +25,8 @@ class MessageInDBBaseDTO(MessageBaseDTO):
 class CachedMessageDTO(MessageBaseDTO):
     model_config = ConfigDict(from_attributes=True)
     id: Optional[int]
+    # Missing in messages cached before sequence numbers existed
+    seq: Optional[int] = None
     timestamp: Optional[datetime]
     sender: UserDTO
 
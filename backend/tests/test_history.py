@@ -0,0 +1,210 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+import time_machine
+
+from database.orm import AsyncORM
+from schemas.messages import CachedMessageDTO
+from schemas.users import UserDTO
+from utils import cache
+from utils.cache import _is_complete, delivered_run, merge_history
+
+NOW = datetime(2026, 10, 19, 12, 0, 0)
+
+SENDER = UserDTO(
+    id=1,
+    username="alice",
+    registered_at=NOW,
+    tg_user_id=None,
+    hashed_password="x",
+)
+
+
+def message(seq, text=None, persisted=False, age=60):
+    """A message of conversation 1:2, received age seconds before NOW"""
+    return CachedMessageDTO(
+        id=seq if persisted and seq is not None else None,
+        sender_id=1,
+        receiver_id=2,
+        message=text or f"m{seq}",
+        sender=SENDER,
+        seq=seq,
+        timestamp=NOW - timedelta(seconds=age),
+    )
+
+
+def messages(seqs, **kwargs):
+    return [message(seq, **kwargs) for seq in seqs]
+
+
+def seqs_of(history):
+    return [m.seq for m in history]
+
+
+class TestMergeHistory:
+    def test_orders_by_seq(self):
+        merged = merge_history(messages([3, 1]), messages([4, 2]), limit=10)
+        assert seqs_of(merged) == [1, 2, 3, 4]
+
+    def test_keeps_first_copy(self):
+        persisted = [message(2, "persisted", persisted=True)]
+        cached = [message(2, "cached")]
+        merged = merge_history(persisted, cached, limit=10)
+        assert [m.message for m in merged] == ["persisted"]
+
+    def test_unsequenced_go_last(self):
+        legacy = message(None, "legacy")
+        merged = merge_history([legacy], messages([1, 2]), limit=10)
+        assert [m.message for m in merged] == ["m1", "m2", "legacy"]
+
+    def test_keeps_newest_up_to_limit(self):
+        merged = merge_history(messages(range(1, 11)), limit=3)
+        assert seqs_of(merged) == [8, 9, 10]
+
+
+class TestIsComplete:
+    def test_window_and_tail_continue(self):
+        assert _is_complete(messages([1, 2, 3]), messages([4, 5]), 5, limit=50)
+
+    def test_full_limit_without_first_message(self):
+        assert _is_complete(messages(range(11, 16)), messages([16]), 16, limit=5)
+
+    def test_short_history_not_from_start(self):
+        assert not _is_complete(messages([11, 12]), messages([13]), 13, limit=50)
+
+    def test_out_of_order_tail(self):
+        assert _is_complete(messages([1, 2]), messages([5, 3, 4]), 5, limit=50)
+
+    def test_gap_between_window_and_tail(self):
+        assert not _is_complete(messages([1, 2]), messages([4, 5]), 5, limit=50)
+
+    def test_gap_inside_tail(self):
+        assert not _is_complete(messages([1, 2]), messages([3, 5]), 5, limit=50)
+
+    def test_message_numbered_but_not_cached_yet(self):
+        assert not _is_complete(messages([1, 2]), messages([3]), 4, limit=50)
+
+    def test_legacy_tail_entry(self):
+        tail = [message(3), message(None)]
+        assert not _is_complete(messages([1, 2]), tail, 3, limit=50)
+
+    def test_missing_counter(self):
+        assert not _is_complete(messages([1, 2]), messages([3]), None, limit=50)
+
+    def test_empty_conversation(self):
+        assert _is_complete([], [], 0, limit=50)
+        assert not _is_complete([], [], 3, limit=50)
+
+    def test_tail_only(self):
+        assert _is_complete([], messages([1, 2]), 2, limit=50)
+
+
+class TestFlushRace:
+    """What a reader sees while a flush of messages 6-10 is in progress"""
+
+    window = messages([1, 2, 3, 4, 5], persisted=True)
+    batch = messages([6, 7, 8, 9, 10])
+
+    def test_before_commit(self):
+        # Only the tail has the batch
+        assert _is_complete(self.window, self.batch, 10, limit=50)
+
+    def test_window_filled_before_trim(self):
+        # The window took the batch, the tail still holds it
+        window = self.window + messages([6, 7, 8, 9, 10], persisted=True)
+        tail = self.batch + [message(11)]
+        assert _is_complete(window, tail, 11, limit=50)
+        merged = merge_history(window, tail, limit=50)
+        assert seqs_of(merged) == list(range(1, 12))
+        assert all(m.id is not None for m in merged[:10])
+
+    def test_batch_gone_from_both(self):
+        # Trimmed before the window has it: the gap must not pass as complete
+        assert not _is_complete(self.window, [message(11)], 11, limit=50)
+
+
+class TestDeliveredRun:
+    @pytest.fixture(autouse=True)
+    def frozen(self):
+        with time_machine.travel(NOW, tick=False):
+            yield
+
+    def test_contiguous(self):
+        assert delivered_run(messages([3, 1, 2])) == (1, 3)
+
+    def test_continues_from_cursor(self):
+        assert delivered_run(messages([5, 6]), after=4) == (5, 6)
+
+    def test_skips_seqs_already_delivered(self):
+        assert delivered_run(messages([3, 4, 5]), after=4) == (5, 5)
+
+    def test_recent_gap_stops_the_run(self):
+        batch = messages([1, 2]) + [message(4, age=1)]
+        assert delivered_run(batch) == (1, 2)
+
+    def test_recent_gap_after_cursor(self):
+        assert delivered_run([message(6, age=1)], after=4) is None
+
+    def test_old_gap_is_skipped(self):
+        # Message 3 was numbered but never stored
+        assert delivered_run(messages([1, 2, 4])) == (1, 4)
+
+    def test_catchup_cut_at_limit(self):
+        assert delivered_run(messages([90, 91]), after=10) == (11, 91)
+
+    def test_nothing_new(self):
+        assert delivered_run(messages([1, 2]), after=2) is None
+        assert delivered_run([message(None)]) is None
+
+
+class FakeMessagesRepo:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    async def get_chat_history(self, sender_id, receiver_id, limit=50, after_seq=0):
+        self.calls.append(after_seq)
+        rows = [row for row in self.rows if row.seq > after_seq]
+        return rows[-limit:]
+
+
+class TestGetMessagesAfter:
+    config = SimpleNamespace(history_size=5, catchup_limit=8)
+
+    @pytest.fixture
+    def history(self, monkeypatch):
+        def use(cached, persisted):
+            async def get_history(*args):
+                return cached
+
+            repo = FakeMessagesRepo(persisted)
+            monkeypatch.setattr(cache, "get_history", get_history)
+            monkeypatch.setattr(AsyncORM, "messages", repo, raising=False)
+            return repo
+
+        return use
+
+    async def test_only_newer_than_cursor(self, history):
+        repo = history(messages([6, 7, 8, 9, 10]), [])
+        missed = await cache.get_messages_after(None, self.config, 1, 2, 7)
+        assert seqs_of(missed) == [8, 9, 10]
+        assert repo.calls == []
+
+    async def test_includes_legacy_entries(self, history):
+        history(messages([6, 7]) + [message(None)], [])
+        missed = await cache.get_messages_after(None, self.config, 1, 2, 6)
+        assert seqs_of(missed) == [7, None]
+
+    async def test_reads_back_past_cached_history(self, history):
+        persisted = messages(range(1, 11), persisted=True)
+        repo = history(messages([6, 7, 8, 9, 10]), persisted)
+        missed = await cache.get_messages_after(None, self.config, 1, 2, 3)
+        assert seqs_of(missed) == [4, 5, 6, 7, 8, 9, 10]
+        assert repo.calls == [3]
+
+    async def test_catchup_limit(self, history):
+        persisted = messages(range(1, 21), persisted=True)
+        history(messages(range(16, 21)), persisted)
+        missed = await cache.get_messages_after(None, self.config, 1, 2, 2)
+        assert seqs_of(missed) == list(range(13, 21))
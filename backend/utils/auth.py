@@ -1,3 +1,5 @@
+import hmac
+
 from fastapi import HTTPException, Request
 from database.orm import AsyncORM
 import jwt
@@ -44,3 +46,14 @@ async def get_current_user(request: Request):
         raise HTTPException(status_code=401, detail="User not found")
 
     return UserDTO.model_validate(user)
+
+
+async def require_admin(request: Request):
+    """
+    Guards operational endpoints, they require the X-Admin-Token header
+    to match ADMIN_TOKEN and are disabled when it is not configured
+    """
+    admin_token = request.app.state.config.secrets.admin
+    provided = request.headers.get("X-Admin-Token")
+    if not admin_token or not provided or not hmac.compare_digest(provided, admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
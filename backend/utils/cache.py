@@ -1,34 +1,688 @@
+import asyncio
 import json
+import logging
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
 from redis.asyncio.client import Redis
+from config import Cache, Outbox
 from database.orm import AsyncORM
+from misc.metrics import (
+    CACHE_BYTES,
+    CACHE_EVICTIONS,
+    CACHE_FLUSH_LATENCY,
+    CACHE_LATENCY,
+    timed,
+)
+from misc.profiling import span
 from schemas.messages import CachedMessageDTO
+from schemas.users import UserDTO
+
+# Sorted set of conversation ids scored by last activity, drives eviction
+ACTIVITY_KEY = "chat:activity"
+# Approximate size in bytes of all cached messages
+BYTES_KEY = "chat:bytes"
+# Held by the worker currently running the janitor
+JANITOR_LOCK_KEY = "chat:janitor"
+# Conversations with staged notifications, scored by when they are due
+OUTBOX_PENDING_KEY = "outbox:pending"
+# Milliseconds a flush may hold its list before another one can take over
+FLUSH_LOCK_TIMEOUT = 60_000
+# A numbered message reaches the cache within milliseconds, a gap in the
+# sequence older than this is a lost message rather than one in flight
+GAP_GRACE = timedelta(seconds=10)
+
+# Keys written before conversation ids were hash-tagged
+LEGACY_KEY_RE = re.compile(r"^chat:(\d+):(\d+)$")
+
+# Drop a conversation from the activity index unless it was touched meanwhile
+FORGET_IF_IDLE_SCRIPT = """
+if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1])) == tonumber(ARGV[2]) then
+    return redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# Next sequence number of a conversation, nil if the counter has to be seeded
+NEXT_SEQ_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if not ARGV[2] then
+        return false
+    end
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+local seq = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return seq
+"""
+
+# Appends to (or replaces) the persisted window and trims it, returns the size change
+WINDOW_SCRIPT = """
+local function size()
+    local total = 0
+    for _, message in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        total = total + #message
+    end
+    return total
+end
+local before = size()
+if ARGV[3] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+for i = 4, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return size() - before
+"""
+
+# Drops flushed entries from the head of a list, appends made meanwhile stay
+TRIM_FLUSHED_SCRIPT = """
+local count = tonumber(ARGV[1])
+if redis.call('LINDEX', KEYS[1], count - 1) == ARGV[count + 1] then
+    redis.call('LTRIM', KEYS[1], count, -1)
+    return count
+end
+-- The list was written again after it expired, remove the copies one by one
+local removed = 0
+for i = 2, #ARGV do
+    removed = removed + redis.call('LREM', KEYS[1], 1, ARGV[i])
+end
+return removed
+"""
+
+# Releases a lock only if it is still held by the caller
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Moves delivery cursors over a contiguous run first..last. A cursor that
+# doesn't reach first - 1 stays put, so the next catch-up fills the gap
+ADVANCE_CURSORS_SCRIPT = """
+local first, last = tonumber(ARGV[1]), tonumber(ARGV[2])
+for _, key in ipairs(KEYS) do
+    local cursor = tonumber(redis.call('GET', key))
+    if cursor == nil or (cursor >= first - 1 and cursor < last) then
+        redis.call('SET', key, last)
+    end
+    redis.call('EXPIRE', key, ARGV[3])
+end
+return #KEYS
+"""
+
+
+def get_conversation_id(sender_id: int, receiver_id: int) -> str:
+    """Identifies the conversation regardless of who sends"""
+    return f"{min(sender_id, receiver_id)}:{max(sender_id, receiver_id)}"
 
 
 def get_cache_key(sender_id: int, receiver_id: int):
-    """Generates a cache key for storing messages between two users"""
-    return f"chat:{min(sender_id, receiver_id)}:{max(sender_id, receiver_id)}"
+    """
+    Generates a cache key for storing messages between two users. The
+    conversation id is a hash tag, so every key of a conversation lands in
+    the same Redis Cluster slot and can be used in one transaction.
+    """
+    return f"chat:{{{get_conversation_id(sender_id, receiver_id)}}}"
 
 
-async def get_cached_messages(redis_client: Redis, sender_id: int, receiver_id: int):
-    """Retrieves cached messages from Redis for the given sender and receiver"""
-    cache_key = get_cache_key(sender_id, receiver_id)
-    cached_messages = await redis_client.lrange(cache_key, 0, -1)
+def get_window_key(sender_id: int, receiver_id: int):
+    """Latest persisted messages of a conversation, read together with the tail"""
+    return f"{get_cache_key(sender_id, receiver_id)}:window"
+
+
+def get_seq_key(sender_id: int, receiver_id: int):
+    """Counter handing out the sequence numbers of a conversation"""
+    return f"{get_cache_key(sender_id, receiver_id)}:seq"
+
+
+def get_cursor_key(sender_id: int, receiver_id: int, user_id: int, device_id: str):
+    """Last sequence number of a conversation delivered to one device of a user"""
+    return f"{get_cache_key(sender_id, receiver_id)}:cursor:{user_id}:{device_id}"
+
+
+def get_outbox_key(sender_id: int, receiver_id: int):
+    """Notifications staged for the participants of a conversation"""
+    return f"{get_cache_key(sender_id, receiver_id)}:outbox"
+
+
+def parse_conversation_id(conversation_id: str) -> tuple[int, int]:
+    sender_id, receiver_id = conversation_id.split(":")
+    return int(sender_id), int(receiver_id)
+
+
+def _decode(raw_messages: list[bytes]) -> list[CachedMessageDTO]:
     return [
         CachedMessageDTO.model_validate(json.loads(msg.decode("utf-8")))
-        for msg in cached_messages
+        for msg in raw_messages
     ]
 
 
-async def cache_message(redis_client: Redis, message: CachedMessageDTO):
-    """Caches a message in Redis for quick access"""
+def _last_seq(raw_message: bytes | None) -> int:
+    if raw_message is None:
+        return 0
+    return _decode([raw_message])[0].seq or 0
+
+
+async def next_seq(
+    redis_client: Redis, config: Cache, sender_id: int, receiver_id: int
+) -> int:
+    """Assigns the next sequence number of a conversation"""
+    seq_key = get_seq_key(sender_id, receiver_id)
+    next_seq_script = redis_client.register_script(NEXT_SEQ_SCRIPT)
+
+    seq = await next_seq_script(keys=[seq_key], args=[config.ttl])
+    if seq is None:
+        # Counter expired or was lost, continue after everything stored so far
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lindex(get_cache_key(sender_id, receiver_id), -1)
+            pipe.lindex(get_window_key(sender_id, receiver_id), -1)
+            tail, window = await pipe.execute()
+        seed = max(
+            await AsyncORM.messages.get_last_seq(sender_id, receiver_id),
+            _last_seq(tail),
+            _last_seq(window),
+        )
+        seq = await next_seq_script(keys=[seq_key], args=[config.ttl, seed])
+    return seq
+
+
+def new_message(
+    sender: UserDTO, receiver_id: int, seq: int, message: str
+) -> CachedMessageDTO:
+    """A message just received, not persisted yet"""
+    return CachedMessageDTO(
+        id=None,
+        sender_id=sender.id,
+        receiver_id=receiver_id,
+        message=message,
+        sender=sender,
+        seq=seq,
+        # Naive UTC, like the timestamps Postgres assigns
+        timestamp=datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+
+
+@timed(CACHE_LATENCY, operation="get_cached_messages")
+async def get_cached_messages(
+    redis_client: Redis, config: Cache, sender_id: int, receiver_id: int
+) -> tuple[list[CachedMessageDTO], list[CachedMessageDTO], int | None]:
+    """
+    Retrieves the persisted window and the unflushed tail of a conversation
+    from Redis, along with the last sequence number handed out
+    """
+    cache_key = get_cache_key(sender_id, receiver_id)
+    window_key = get_window_key(sender_id, receiver_id)
+    seq_key = get_seq_key(sender_id, receiver_id)
+
+    # Reading counts as activity: keep the lists alive and away from eviction
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.lrange(window_key, 0, -1)
+        pipe.lrange(cache_key, 0, -1)
+        pipe.get(seq_key)
+        for key in (cache_key, window_key, seq_key):
+            pipe.expire(key, config.ttl)
+        pipe.zadd(
+            ACTIVITY_KEY,
+            {get_conversation_id(sender_id, receiver_id): time.time()},
+            xx=True,
+        )
+        window, tail, last_seq, *_ = await pipe.execute()
+
+    return _decode(window), _decode(tail), int(last_seq) if last_seq else None
+
+
+async def get_unflushed_messages(
+    redis_client: Redis, sender_id: int, receiver_id: int
+) -> list[CachedMessageDTO]:
+    """Messages of a conversation not written to the database yet"""
+    return _decode(
+        await redis_client.lrange(get_cache_key(sender_id, receiver_id), 0, -1)
+    )
+
+
+def merge_history(*sources: list[CachedMessageDTO], limit: int):
+    """Orders messages by sequence number, keeping the first copy of each"""
+    by_seq = {}
+    unsequenced = []
+    for messages in sources:
+        for message in messages:
+            if message.seq is None:
+                unsequenced.append(message)
+            else:
+                by_seq.setdefault(message.seq, message)
+    merged = [by_seq[seq] for seq in sorted(by_seq)] + unsequenced
+    return merged[-limit:]
+
+
+def _is_complete(
+    window: list[CachedMessageDTO],
+    tail: list[CachedMessageDTO],
+    last_seq: int | None,
+    limit: int,
+) -> bool:
+    """Whether the window and the tail together are the latest history"""
+    if last_seq is None:
+        return False
+    if not (window or tail):
+        # Seeded at 0 when the database had no messages either
+        return last_seq == 0
+    # Cached before sequence numbers existed, their place is unknown
+    if any(message.seq is None for message in tail):
+        return False
+
+    # A flush leaves its batch in the tail until the window has it, and
+    # concurrent appends may land out of order: compare sets of seqs
+    newest_persisted = max((message.seq for message in window), default=0)
+    unflushed = sorted(
+        {message.seq for message in tail if message.seq > newest_persisted}
+    )
+    seqs = ([newest_persisted] if window else []) + unflushed
+    if any(b != a + 1 for a, b in zip(seqs, seqs[1:])):
+        return False
+
+    # Nothing may have been handed out after the newest cached message
+    if seqs[-1] != last_seq:
+        return False
+    oldest = min(message.seq for message in window or tail)
+    return len(window) + len(unflushed) >= limit or oldest == 1
+
+
+async def _fill_window(
+    redis_client: Redis,
+    config: Cache,
+    sender_id: int,
+    receiver_id: int,
+    messages: list[CachedMessageDTO],
+    replace: bool = False,
+):
+    """Appends persisted messages to the window, or replaces it"""
+    if not messages and not replace:
+        return
+    window_script = redis_client.register_script(WINDOW_SCRIPT)
+    grown = await window_script(
+        keys=[get_window_key(sender_id, receiver_id)],
+        args=[
+            config.history_size,
+            config.ttl,
+            int(replace),
+            *(message.model_dump_json() for message in messages),
+        ],
+    )
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.incrby(BYTES_KEY, grown)
+        if messages:
+            pipe.zadd(
+                ACTIVITY_KEY, {get_conversation_id(sender_id, receiver_id): time.time()}
+            )
+        await pipe.execute()
+
+
+async def get_history(
+    redis_client: Redis, config: Cache, sender_id: int, receiver_id: int
+) -> list[CachedMessageDTO]:
+    """
+    Returns the latest messages of a conversation, oldest first. Served from
+    Redis when the cached window and tail add up to the full history, else
+    the persisted rows are read once and cached as the new window.
+    """
+    window, tail, last_seq = await get_cached_messages(
+        redis_client, config, sender_id, receiver_id
+    )
+    if _is_complete(window, tail, last_seq, config.history_size):
+        return merge_history(window, tail, limit=config.history_size)
+
+    persisted = [
+        CachedMessageDTO.model_validate(message)
+        for message in await AsyncORM.messages.get_chat_history(
+            sender_id, receiver_id, limit=config.history_size
+        )
+    ]
+    await _fill_window(
+        redis_client, config, sender_id, receiver_id, persisted, replace=True
+    )
+    if last_seq is None:
+        # Missing after the seq migration or an idle TTL. Without it every
+        # connect would read the database until the next message is sent.
+        # NX: a message numbered meanwhile has seeded it already
+        await redis_client.set(
+            get_seq_key(sender_id, receiver_id),
+            max((message.seq or 0 for message in persisted + tail), default=0),
+            ex=config.ttl,
+            nx=True,
+        )
+    # Persisted copies win, the tail adds what is not flushed yet
+    return merge_history(persisted, tail, limit=config.history_size)
+
+
+async def get_cursor(
+    redis_client: Redis, user_id: int, peer_id: int, device_id: str
+) -> int | None:
+    """Where a device left off in a conversation, None if it never synced"""
+    cursor = await redis_client.get(get_cursor_key(user_id, peer_id, user_id, device_id))
+    return int(cursor) if cursor is not None else None
+
+
+def delivered_run(
+    messages: list[CachedMessageDTO], after: int | None = None
+) -> tuple[int, int] | None:
+    """
+    First and last seq a batch covers without gaps, continuing from after
+    when given. A gap is skipped when the message following it is older than
+    GAP_GRACE: the missing one was lost or left out on purpose, not in flight.
+    """
+    by_seq = {message.seq: message for message in messages if message.seq is not None}
+    threshold = datetime.now(timezone.utc).replace(tzinfo=None) - GAP_GRACE
+
+    first, last = None, after
+    for seq in sorted(by_seq):
+        if last is not None and seq <= last:
+            continue
+        timestamp = by_seq[seq].timestamp
+        if last is not None and seq != last + 1 and timestamp and timestamp > threshold:
+            break
+        if first is None:
+            first = seq if last is None else last + 1
+        last = seq
+    return (first, last) if first is not None else None
+
+
+async def save_cursors(
+    redis_client: Redis,
+    config: Cache,
+    sender_id: int,
+    receiver_id: int,
+    connections: list,
+    messages: list[CachedMessageDTO],
+    after: int | None = None,
+):
+    """
+    Records that these messages reached the connections, after is the cursor
+    they continue from. Cursors only move over messages contiguous with them,
+    one that missed a message stays before it and gets it on the next catch-up.
+    """
+    keys = [
+        get_cursor_key(sender_id, receiver_id, connection.user_id, connection.device_id)
+        for connection in connections
+        if connection.device_id is not None
+    ]
+    run = delivered_run(messages, after)
+    if not keys or run is None:
+        return
+    # Every cursor of a conversation shares its hash tag, one call covers all devices
+    advance_cursors = redis_client.register_script(ADVANCE_CURSORS_SCRIPT)
+    await advance_cursors(keys=keys, args=[*run, config.cursor_ttl])
+
+
+async def get_messages_after(
+    redis_client: Redis,
+    config: Cache,
+    sender_id: int,
+    receiver_id: int,
+    after_seq: int,
+) -> list[CachedMessageDTO]:
+    """Messages of a conversation a device hasn't received, the newest catchup_limit"""
+    history = await get_history(redis_client, config, sender_id, receiver_id)
+    missed = [
+        message
+        for message in history
+        if message.seq is None or message.seq > after_seq
+    ]
+
+    if history and history[0].seq is not None and history[0].seq > after_seq + 1:
+        # Away for longer than the cached history reaches back
+        persisted = [
+            CachedMessageDTO.model_validate(message)
+            for message in await AsyncORM.messages.get_chat_history(
+                sender_id,
+                receiver_id,
+                limit=config.catchup_limit,
+                after_seq=after_seq,
+            )
+        ]
+        missed = merge_history(persisted, missed, limit=config.catchup_limit)
+    return missed
+
+
+def stage_notification(pipe, message: CachedMessageDTO):
+    """
+    Queues commands recording that the receiver should be notified of the
+    message. Intents are kept per receiver, a burst of messages only bumps
+    the count and replaces the text, so it ends up as one notification.
+    """
+    outbox_key = get_outbox_key(message.sender_id, message.receiver_id)
+    pipe.hincrby(outbox_key, f"{message.receiver_id}:count", 1)
+    pipe.hset(
+        outbox_key,
+        f"{message.receiver_id}:last",
+        json.dumps(
+            {
+                "sender_id": message.sender_id,
+                "sender_username": message.sender.username,
+                "message": message.message,
+            }
+        ),
+    )
+
+
+def index_notification(pipe, conversation_id: str, due: float):
+    # NX: later messages join the pending notification instead of postponing it
+    pipe.zadd(OUTBOX_PENDING_KEY, {conversation_id: due}, nx=True)
+
+
+@timed(CACHE_LATENCY, operation="cache_message")
+async def cache_message(
+    redis_client: Redis,
+    config: Cache,
+    message: CachedMessageDTO,
+    notify: Outbox | None = None,
+):
+    """
+    Caches a message in Redis for quick access. With notify, a notification
+    intent for the receiver is committed in the same transaction.
+    """
     cache_key = get_cache_key(message.sender_id, message.receiver_id)
+    conversation_id = get_conversation_id(message.sender_id, message.receiver_id)
+    raw = message.model_dump_json()
 
-    await redis_client.rpush(cache_key, message.model_dump_json())
+    if notify is None:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(cache_key, raw)
+            pipe.expire(cache_key, config.ttl)
+            pipe.zadd(ACTIVITY_KEY, {conversation_id: time.time()})
+            pipe.incrby(BYTES_KEY, len(raw))
+            length, _, _, _ = await pipe.execute()
+    else:
+        # The list and the outbox share the conversation's hash slot
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(cache_key, raw)
+            pipe.expire(cache_key, config.ttl)
+            stage_notification(pipe, message)
+            length, *_ = await pipe.execute()
 
-    if await redis_client.llen(cache_key) > 50:
-        # If more than 10 messages are cached, store them in the database and clear the cache
-        messages = await get_cached_messages(
-            redis_client, message.sender_id, message.receiver_id
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zadd(ACTIVITY_KEY, {conversation_id: time.time()})
+            pipe.incrby(BYTES_KEY, len(raw))
+            index_notification(pipe, conversation_id, time.time() + notify.delay)
+            await pipe.execute()
+
+    if length > config.flush_threshold:
+        # Enough messages are cached, store them in the database and clear the cache
+        await flush_cached_messages(
+            redis_client, config, message.sender_id, message.receiver_id
         )
-        await AsyncORM.messages.add_cached_messages(messages)
-        await redis_client.delete(cache_key)
+
+
+async def _flush_key(
+    redis_client: Redis,
+    config: Cache,
+    cache_key: str | bytes,
+    accounted: bool = True,
+    on_persisted=None,
+) -> tuple[list[CachedMessageDTO], int]:
+    """
+    Moves the messages of one list into the database, returns them and the
+    bytes freed. Entries leave the list only after their rows are committed
+    (and on_persisted ran), so a reader always finds them in one of the two.
+    """
+    if isinstance(cache_key, bytes):
+        cache_key = cache_key.decode("utf-8")
+
+    # Two flushes of the same list would insert the same rows twice
+    lock_key = f"{cache_key}:flushing"
+    token = uuid.uuid4().hex
+    if not await redis_client.set(lock_key, token, nx=True, px=FLUSH_LOCK_TIMEOUT):
+        return [], 0
+
+    try:
+        with CACHE_FLUSH_LATENCY.time(), span("cache.flush", key=cache_key):
+            cached_messages = await redis_client.lrange(cache_key, 0, -1)
+            if not cached_messages:
+                return [], 0
+
+            # Messages loaded from the database are cached with their id, skip them
+            new_messages = [
+                message for message in _decode(cached_messages) if message.id is None
+            ]
+            if new_messages:
+                # Cached before sequence numbers existed, number them now
+                for message in new_messages:
+                    if message.seq is None:
+                        message.seq = await next_seq(
+                            redis_client, config, message.sender_id, message.receiver_id
+                        )
+                # Appends may land out of order, the window is kept in seq order
+                new_messages.sort(key=lambda message: message.seq)
+                await AsyncORM.messages.add_cached_messages(new_messages)
+
+            try:
+                if on_persisted is not None:
+                    await on_persisted(new_messages)
+            finally:
+                # Committed, leaving them in the list would insert them again
+                trim_flushed = redis_client.register_script(TRIM_FLUSHED_SCRIPT)
+                await trim_flushed(
+                    keys=[cache_key], args=[len(cached_messages), *cached_messages]
+                )
+    finally:
+        release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+        await release_lock(keys=[lock_key], args=[token])
+
+    freed = sum(len(msg) for msg in cached_messages)
+    if accounted:
+        await redis_client.decrby(BYTES_KEY, freed)
+    return new_messages, freed
+
+
+async def flush_cached_messages(
+    redis_client: Redis,
+    config: Cache,
+    sender_id: int,
+    receiver_id: int,
+    keep_window: bool = True,
+) -> int:
+    """
+    Moves the cached messages of a conversation into the database. They stay
+    readable from the window unless keep_window is False, then the window is
+    dropped as well. Returns the bytes freed.
+    """
+    # The window takes the batch before the tail lets go of it
+    fill_window = partial(_fill_window, redis_client, config, sender_id, receiver_id)
+    persisted, freed = await _flush_key(
+        redis_client,
+        config,
+        get_cache_key(sender_id, receiver_id),
+        on_persisted=fill_window if keep_window else None,
+    )
+    if not keep_window:
+        freed += await _drop_window(redis_client, sender_id, receiver_id)
+    return freed
+
+
+async def _drop_window(redis_client: Redis, sender_id: int, receiver_id: int) -> int:
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lrange(get_window_key(sender_id, receiver_id), 0, -1)
+        pipe.delete(get_window_key(sender_id, receiver_id))
+        window, _ = await pipe.execute()
+
+    freed = sum(len(msg) for msg in window)
+    if freed:
+        await redis_client.decrby(BYTES_KEY, freed)
+    return freed
+
+
+async def migrate_legacy_cache(redis_client: Redis, config: Cache):
+    """Flushes lists left under the pre hash-tag key names into the database"""
+    async for key in redis_client.scan_iter(match="chat:*", count=1000):
+        if LEGACY_KEY_RE.match(key.decode("utf-8")):
+            await _flush_key(redis_client, config, key, accounted=False)
+
+
+async def _evict(
+    redis_client: Redis, config: Cache, forget_if_idle, candidates, reason: str
+) -> int:
+    freed = 0
+    for conversation_id, score in candidates:
+        conversation_id = conversation_id.decode("utf-8")
+        freed += await flush_cached_messages(
+            redis_client,
+            config,
+            *parse_conversation_id(conversation_id),
+            keep_window=False,
+        )
+        # A message may have arrived after the flush, then it stays indexed
+        await forget_if_idle(keys=[ACTIVITY_KEY], args=[conversation_id, repr(score)])
+        CACHE_EVICTIONS.labels(reason).inc()
+    return freed
+
+
+async def sweep_cache(redis_client: Redis, config: Cache, forget_if_idle):
+    """
+    Flushes conversations idle for longer than idle_flush (well before their
+    TTL could drop unflushed messages), then flushes the least recently
+    active ones until the cache fits into max_bytes
+    """
+    idle = await redis_client.zrangebyscore(
+        ACTIVITY_KEY,
+        "-inf",
+        time.time() - config.idle_flush,
+        start=0,
+        num=config.janitor_batch,
+        withscores=True,
+    )
+    await _evict(redis_client, config, forget_if_idle, idle, "idle")
+
+    while int(await redis_client.get(BYTES_KEY) or 0) > config.max_bytes:
+        oldest = await redis_client.zrange(
+            ACTIVITY_KEY, 0, config.janitor_batch - 1, withscores=True
+        )
+        # Stop if nothing could be freed, the counter may have drifted
+        if not oldest or not await _evict(
+            redis_client, config, forget_if_idle, oldest, "memory"
+        ):
+            break
+
+    CACHE_BYTES.set(int(await redis_client.get(BYTES_KEY) or 0))
+
+
+async def run_cache_janitor(redis_client: Redis, config: Cache):
+    """Periodically sweeps the cache, one worker at a time, until cancelled"""
+    forget_if_idle = redis_client.register_script(FORGET_IF_IDLE_SCRIPT)
+
+    while True:
+        await asyncio.sleep(config.janitor_interval)
+        try:
+            acquired = await redis_client.set(
+                JANITOR_LOCK_KEY, 1, nx=True, px=int(config.janitor_interval * 1000)
+            )
+            if acquired:
+                await sweep_cache(redis_client, config, forget_if_idle)
+        except Exception:
+            logging.exception("Cache janitor failed")
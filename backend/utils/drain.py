@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import time
+
+from fastapi import FastAPI
+
+from utils.cache import flush_cached_messages
+
+
+async def _drain(app: FastAPI) -> dict:
+    manager = app.state.manager
+    config = app.state.config.drain
+    started = time.monotonic()
+
+    # Collected before closing, the sockets carry the conversation ids
+    conversations = {
+        (min(pair), max(pair)) for pair in manager.conversations()
+    }
+    closed = await manager.drain(config)
+
+    # Nothing can be appended by this node anymore, persist what is buffered
+    remaining = max(0.0, config.deadline - (time.monotonic() - started))
+    flushes = [
+        flush_cached_messages(
+            app.state.redis, app.state.config.cache, sender_id, receiver_id
+        )
+        for sender_id, receiver_id in conversations
+    ]
+    try:
+        results = await asyncio.wait_for(
+            asyncio.gather(*flushes, return_exceptions=True), timeout=remaining
+        )
+        failed = sum(isinstance(result, Exception) for result in results)
+    except asyncio.TimeoutError:
+        failed = len(flushes)
+        logging.warning("Drain deadline reached before all caches were flushed")
+
+    logging.info(
+        f"Drained {closed} sockets, flushed {len(conversations) - failed}"
+        f"/{len(conversations)} conversations"
+    )
+    return {
+        "sockets": closed,
+        "conversations": len(conversations),
+        "flush_failures": failed,
+    }
+
+
+async def drain(app: FastAPI) -> dict:
+    """
+    Graceful drain: refuse new sockets, tell clients to reconnect elsewhere
+    and flush the conversations they had open. Safe to call several times,
+    e.g. from a preStop hook and again on shutdown.
+    """
+    if getattr(app.state, "drain_task", None) is None:
+        app.state.drain_task = asyncio.create_task(_drain(app))
+    return await asyncio.shield(app.state.drain_task)
@@ -0,0 +1,90 @@
+import csv
+import io
+import json
+from typing import AsyncIterator
+
+from redis.asyncio.client import Redis
+
+from database.orm import AsyncORM
+from utils.cache import get_unflushed_messages
+
+# Rows fetched from the server-side cursor and written per chunk
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FIELDS = (
+    "id",
+    "seq",
+    "sender_id",
+    "sender_username",
+    "receiver_id",
+    "message",
+    "timestamp",
+)
+
+
+def _ndjson(records: list[dict]) -> str:
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+def _csv(records: list[dict]) -> str:
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, EXPORT_FIELDS).writerows(records)
+    return buffer.getvalue()
+
+
+def _csv_header() -> str:
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, EXPORT_FIELDS).writeheader()
+    return buffer.getvalue()
+
+
+# Media type, file extension and encoder per export format
+export_formats = {
+    "ndjson": ("application/x-ndjson", "ndjson", _ndjson),
+    "csv": ("text/csv", "csv", _csv),
+}
+
+
+def _record(message, sender_username: str) -> dict:
+    timestamp = message.timestamp
+    return {
+        "id": message.id,
+        "seq": message.seq,
+        "sender_id": message.sender_id,
+        "sender_username": sender_username,
+        "receiver_id": message.receiver_id,
+        "message": message.message,
+        "timestamp": timestamp.isoformat() if timestamp else None,
+    }
+
+
+async def export_conversation(
+    redis_client: Redis, sender_id: int, receiver_id: int, export_format: str
+) -> AsyncIterator[str]:
+    """
+    Yields a conversation in the given format, chunk by chunk: the persisted
+    messages from a server-side cursor, then the unflushed Redis tail.
+    Memory use doesn't depend on the size of the conversation.
+    """
+    encode = export_formats[export_format][2]
+    if export_format == "csv":
+        yield _csv_header()
+
+    # Read first: messages flushed while the cursor runs are then still
+    # exported, and ones both flushed and cached are skipped by seq
+    tail = await get_unflushed_messages(redis_client, sender_id, receiver_id)
+
+    last_seq = 0
+    async for rows in AsyncORM.messages.stream_chat_history(
+        sender_id, receiver_id, batch_size=EXPORT_BATCH_SIZE
+    ):
+        yield encode([_record(row, row.sender_username) for row in rows])
+        last_seq = rows[-1].seq
+
+    records = [
+        _record(message, message.sender.username)
+        for message in tail
+        if message.seq is None or message.seq > last_seq
+    ]
+    if records:
+        yield encode(records)
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import re
+import time
+
+from redis.asyncio.client import Redis
+
+from config import Outbox
+from database.orm import AsyncORM
+from misc.metrics import NOTIFICATIONS_COALESCED, NOTIFICATIONS_RELAYED
+from misc.task_dispatcher import TaskDispatcher
+from schemas.messages import CachedMessageDTO
+from utils.cache import (
+    OUTBOX_PENDING_KEY,
+    get_conversation_id,
+    get_outbox_key,
+    index_notification,
+    parse_conversation_id,
+    stage_notification,
+)
+
+# Held by the worker currently relaying notifications
+RELAY_LOCK_KEY = "outbox:relay"
+# Held by the worker that last scanned for unindexed notifications
+REINDEX_LOCK_KEY = "outbox:reindex"
+
+OUTBOX_KEY_RE = re.compile(r"^chat:\{(\d+:\d+)\}:outbox$")
+
+
+async def notify_later(redis_client: Redis, config: Outbox, message: CachedMessageDTO):
+    """Stages a notification for a message that is already cached"""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        stage_notification(pipe, message)
+        await pipe.execute()
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        index_notification(
+            pipe,
+            get_conversation_id(message.sender_id, message.receiver_id),
+            time.time() + config.delay,
+        )
+        await pipe.execute()
+
+
+async def _take(redis_client: Redis, conversation_id: str) -> list[dict]:
+    """Removes the staged notifications of a conversation and returns them"""
+    outbox_key = get_outbox_key(*parse_conversation_id(conversation_id))
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(outbox_key)
+        pipe.delete(outbox_key)
+        fields, _ = await pipe.execute()
+
+    by_receiver = {}
+    for field, value in fields.items():
+        receiver_id, kind = field.decode("utf-8").split(":")
+        by_receiver.setdefault(int(receiver_id), {})[kind] = value
+
+    return [
+        {
+            "receiver_id": receiver_id,
+            "count": int(intent.get("count", 1)),
+            **json.loads(intent["last"]),
+        }
+        for receiver_id, intent in by_receiver.items()
+        if "last" in intent
+    ]
+
+
+async def _restage(
+    redis_client: Redis, config: Outbox, conversation_ids: list, intents: list[dict]
+):
+    """Puts notifications back after a failed relay, keeping newer messages"""
+    for intent in intents:
+        outbox_key = get_outbox_key(intent["sender_id"], intent["receiver_id"])
+        last = {
+            key: intent[key] for key in ("sender_id", "sender_username", "message")
+        }
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hincrby(outbox_key, f"{intent['receiver_id']}:count", intent["count"])
+            pipe.hsetnx(outbox_key, f"{intent['receiver_id']}:last", json.dumps(last))
+            await pipe.execute()
+
+    due = time.time() + config.retry_delay
+    await redis_client.zadd(
+        OUTBOX_PENDING_KEY,
+        {conversation_id: due for conversation_id in conversation_ids},
+        nx=True,
+    )
+
+
+async def relay_notifications(
+    redis_client: Redis, dispatcher: TaskDispatcher, config: Outbox
+) -> int:
+    """
+    Publishes the notifications that are due in one batch, returns how many
+    conversations were handled. Receivers are looked up with a single query,
+    and nothing leaves the outbox unless the broker accepted it.
+    """
+    due = await redis_client.zrangebyscore(
+        OUTBOX_PENDING_KEY, "-inf", time.time(), start=0, num=config.batch_size
+    )
+    if not due:
+        return 0
+
+    # Unindexed before taking, a message staged in between indexes itself again
+    await redis_client.zrem(OUTBOX_PENDING_KEY, *due)
+
+    intents = []
+    try:
+        for conversation_id in due:
+            intents.extend(await _take(redis_client, conversation_id.decode("utf-8")))
+
+        receivers = await AsyncORM.users.get_many(
+            intent["receiver_id"] for intent in intents
+        )
+        tg_user_ids = {
+            user_id: user.tg_user_id
+            for user_id, user in receivers.items()
+            if user.tg_user_id
+        }
+        batch = [
+            (
+                "tasks.SendMessageToTG",
+                [
+                    tg_user_ids[intent["receiver_id"]],
+                    intent["sender_username"],
+                    intent["message"],
+                    intent["count"],
+                ],
+            )
+            for intent in intents
+            if intent["receiver_id"] in tg_user_ids
+        ]
+        if batch:
+            await dispatcher.publish(batch)
+    except BaseException:
+        # Also on cancellation at shutdown, taken intents must not be lost
+        await _restage(redis_client, config, due, intents)
+        raise
+
+    NOTIFICATIONS_RELAYED.inc(len(batch))
+    NOTIFICATIONS_COALESCED.inc(sum(intent["count"] - 1 for intent in intents))
+    return len(due)
+
+
+async def reindex_notifications(redis_client: Redis) -> int:
+    """
+    Indexes staged notifications missing from the pending index, returns how
+    many were added. Intents are committed before their index entry, a crash
+    or Redis error in between would strand them until the next message.
+    """
+    conversation_ids = []
+    async for key in redis_client.scan_iter(match="chat:{*}:outbox", count=1000):
+        match = OUTBOX_KEY_RE.match(key.decode("utf-8"))
+        if match:
+            conversation_ids.append(match.group(1))
+    if not conversation_ids:
+        return 0
+
+    # NX: indexed notifications keep their due time, the stranded ones are overdue
+    added = await redis_client.zadd(
+        OUTBOX_PENDING_KEY,
+        {conversation_id: time.time() for conversation_id in conversation_ids},
+        nx=True,
+    )
+    if added:
+        logging.warning(f"Re-indexed {added} stranded notifications")
+    return added
+
+
+async def run_outbox_relay(
+    redis_client: Redis, dispatcher: TaskDispatcher, config: Outbox
+):
+    """Relays due notifications, one worker at a time, until cancelled"""
+    loop = asyncio.get_running_loop()
+    # Also right after start, a crash is what usually strands a notification
+    next_reindex = loop.time()
+
+    while True:
+        await asyncio.sleep(config.interval)
+        try:
+            if loop.time() >= next_reindex:
+                next_reindex = loop.time() + config.reindex_interval
+                if await redis_client.set(
+                    REINDEX_LOCK_KEY,
+                    1,
+                    nx=True,
+                    px=int(config.reindex_interval * 1000),
+                ):
+                    await reindex_notifications(redis_client)
+
+            acquired = await redis_client.set(
+                RELAY_LOCK_KEY, 1, nx=True, px=int(config.interval * 1000)
+            )
+            if not acquired:
+                continue
+            # Keep going while full batches come back, there is a backlog
+            while (
+                await relay_notifications(redis_client, dispatcher, config)
+                >= config.batch_size
+            ):
+                pass
+        except Exception:
+            logging.exception("Outbox relay failed, notifications are kept")
@@ -0,0 +1,278 @@
+"""
+WebSocket load test for the chat backend.
+
+Registers users, opens a socket per user (connect storm), streams messages
+between pairs at a fixed rate and reports throughput, end-to-end latency
+percentiles, connect-storm time and database query counts (scraped from
+/metrics). Results are printed and written as JSON so builds can be compared.
+
+    python benchmarks/ws_load.py --start-server --pairs 1000 --rate 2 --duration 30
+
+The per-user rate limit (RATE_LIMIT_USER_RATE) must allow the chosen --rate,
+otherwise most messages are rejected and reported as such.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+BENCH_PREFIX = "bench:"
+METRIC_LINE_RE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+([0-9.eE+-]+)$")
+DB_METRICS = ("chat_db_query_seconds_count", "chat_db_operation_seconds_count")
+
+
+@dataclass
+class Stats:
+    connected: int = 0
+    connect_failures: int = 0
+    sent: int = 0
+    received: int = 0
+    rejected: int = 0
+    send_errors: int = 0
+    latencies: list = field(default_factory=list)
+
+
+def percentile(values: list, q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def parse_metrics(text: str) -> dict:
+    """Sum Prometheus samples by metric name, ignoring labels"""
+    totals = {}
+    for line in text.splitlines():
+        match = METRIC_LINE_RE.match(line)
+        if match:
+            name, _, value = match.groups()
+            totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+
+async def scrape_db_queries(client: httpx.AsyncClient) -> dict:
+    try:
+        response = await client.get("/metrics")
+        totals = parse_metrics(response.text)
+    except httpx.HTTPError:
+        return {}
+    return {name: totals.get(name, 0) for name in DB_METRICS}
+
+
+def diff(after: dict, before: dict) -> dict:
+    return {name: after.get(name, 0) - before.get(name, 0) for name in after}
+
+
+async def register_users(client: httpx.AsyncClient, count: int, concurrency: int):
+    """Create throwaway users, returns their ids"""
+    run_id = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def register(index: int) -> int:
+        async with semaphore:
+            response = await client.post(
+                "/users/register/",
+                data={"username": f"bench-{run_id}-{index}", "password": run_id},
+            )
+            response.raise_for_status()
+            return response.json()["data"]["user_id"]
+
+    return await asyncio.gather(*(register(index) for index in range(count)))
+
+
+async def reader(ws, stats: Stats):
+    """Consume frames, recording latency of benchmark messages"""
+    async for frame in ws:
+        if frame.startswith("{"):
+            event = json.loads(frame)
+            if event.get("type") == "ping":
+                await ws.send(json.dumps({"type": "pong"}))
+            elif event.get("code") == "rate_limited":
+                stats.rejected += 1
+            continue
+
+        _, _, text = frame.partition(": ")
+        if text.startswith(BENCH_PREFIX):
+            sent_at = int(text[len(BENCH_PREFIX):].split(":", 1)[0])
+            stats.latencies.append((time.time_ns() - sent_at) / 1e6)
+            stats.received += 1
+
+
+async def writer(ws, stats: Stats, rate: float, deadline: float):
+    """Send messages at a fixed rate until the deadline"""
+    interval = 1 / rate
+    sequence = 0
+    next_send = time.monotonic()
+    while next_send < deadline:
+        await asyncio.sleep(max(0, next_send - time.monotonic()))
+        try:
+            await ws.send(f"{BENCH_PREFIX}{time.time_ns()}:{sequence}")
+            stats.sent += 1
+        except websockets.ConnectionClosed:
+            stats.send_errors += 1
+            return
+        sequence += 1
+        next_send += interval
+
+
+async def run(args) -> dict:
+    ws_url = args.base_url.replace("http", "ws", 1)
+    stats = Stats()
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=60) as client:
+        user_ids = await register_users(client, args.pairs * 2, args.register_concurrency)
+        pairs = [(user_ids[i], user_ids[i + 1]) for i in range(0, len(user_ids), 2)]
+        offline_pairs = int(len(pairs) * args.offline_ratio)
+
+        # Senders always connect, receivers of "offline" pairs never do
+        endpoints = []
+        for index, (sender, receiver) in enumerate(pairs):
+            endpoints.append((sender, receiver, True))
+            if index >= offline_pairs:
+                endpoints.append((receiver, sender, False))
+
+        db_start = await scrape_db_queries(client)
+
+        semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+        async def open_socket(user_id: int, peer_id: int):
+            async with semaphore:
+                try:
+                    ws = await websockets.connect(
+                        f"{ws_url}/chat/ws/{user_id}/{peer_id}", open_timeout=30
+                    )
+                except Exception:
+                    stats.connect_failures += 1
+                    return None
+                stats.connected += 1
+                return ws
+
+        storm_start = time.perf_counter()
+        sockets = await asyncio.gather(
+            *(open_socket(user_id, peer_id) for user_id, peer_id, _ in endpoints)
+        )
+        connect_storm = time.perf_counter() - storm_start
+
+        db_after_connect = await scrape_db_queries(client)
+
+        readers = [
+            asyncio.create_task(reader(ws, stats)) for ws in sockets if ws is not None
+        ]
+
+        deadline = time.monotonic() + args.duration
+        send_start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                writer(ws, stats, args.rate, deadline)
+                for ws, (_, _, is_sender) in zip(sockets, endpoints)
+                if ws is not None and is_sender
+            )
+        )
+        send_elapsed = time.perf_counter() - send_start
+
+        # Let in-flight messages arrive
+        await asyncio.sleep(args.drain)
+        for task in readers:
+            task.cancel()
+        await asyncio.gather(
+            *(ws.close() for ws in sockets if ws is not None), return_exceptions=True
+        )
+
+        db_end = await scrape_db_queries(client)
+
+    return {
+        "config": vars(args),
+        "sockets": {
+            "connected": stats.connected,
+            "failed": stats.connect_failures,
+            "connect_storm_seconds": round(connect_storm, 3),
+        },
+        "messages": {
+            "sent": stats.sent,
+            "received": stats.received,
+            "rejected": stats.rejected,
+            "send_errors": stats.send_errors,
+            "send_throughput_per_second": round(stats.sent / send_elapsed, 1),
+            "receive_throughput_per_second": round(stats.received / send_elapsed, 1),
+        },
+        "latency_ms": {
+            "p50": percentile(stats.latencies, 50),
+            "p90": percentile(stats.latencies, 90),
+            "p99": percentile(stats.latencies, 99),
+            "max": max(stats.latencies, default=None),
+        },
+        "db_queries": {
+            "connect": diff(db_after_connect, db_start),
+            "messages": diff(db_end, db_after_connect),
+        },
+    }
+
+
+async def wait_for_server(base_url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/health/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"Backend at {base_url} did not start in {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument(
+        "--start-server",
+        action="store_true",
+        help="run backend/main.py against the Postgres/Redis from backend/.env",
+    )
+    parser.add_argument("--pairs", type=int, default=500, help="conversations to open")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages/s per sender")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument(
+        "--offline-ratio",
+        type=float,
+        default=0.1,
+        help="share of conversations whose receiver never connects",
+    )
+    parser.add_argument("--connect-concurrency", type=int, default=500)
+    parser.add_argument("--register-concurrency", type=int, default=50)
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    server = None
+    if args.start_server:
+        server = subprocess.Popen([sys.executable, "main.py"], cwd=BACKEND_DIR)
+
+    try:
+        if server:
+            asyncio.run(wait_for_server(args.base_url, timeout=60))
+        results = asyncio.run(run(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps({key: results[key] for key in results if key != "config"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from celery import Celery
 from environs import Env
+from redis import Redis
 from tasks import SendMessageToTG
 
 env = Env()
@@ -11,21 +12,33 @@ redis_host = env.str("REDIS_HOST")
 
 tgbot_token = env.str("BOT_TOKEN")
 
+# Delivery attempts before a notification is dead-lettered
+tg_max_attempts = env.int("TG_MAX_ATTEMPTS", 5)
+# Telegram requests in flight per worker process
+tg_max_concurrency = env.int("TG_MAX_CONCURRENCY", 100)
+
 
 celery_app = Celery(
     "chat_tasks",
     broker=f"redis://:{redis_pass}@{redis_host}:{redis_port}/1",
-    backend=f"redis://:{redis_pass}@{redis_host}:{redis_port}/0",
 )
 
+# Tasks are fire-and-forget, nobody reads their results
 celery_app.conf.update(
     task_serializer="json",
     accept_content=["json"],
-    result_serializer="json",
+    task_ignore_result=True,
     timezone="UTC",
     enable_utc=True,
 )
 
 
-notify_tg = SendMessageToTG(tgbot_token)
+redis_client = Redis(host=redis_host, port=redis_port, password=redis_pass, db=0)
+
+notify_tg = SendMessageToTG(
+    tgbot_token,
+    redis_client,
+    max_attempts=tg_max_attempts,
+    max_concurrency=tg_max_concurrency,
+)
 celery_app.register_task(notify_tg)
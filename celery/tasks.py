@@ -1,20 +1,171 @@
 import asyncio
-from celery import Task
+import html
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from celery import Task
+from redis import Redis
+
+DEAD_LETTER_KEY = "tg:dead_letter"
+# Characters Telegram accepts in one sendMessage
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class AsyncRunner:
+    """
+    Event loop running in a background thread of the worker process. Tasks
+    executed by the thread pool submit coroutines to it, so all of them
+    share one loop and one HTTP session and their requests run concurrently.
+    """
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        # Started lazily, and again after a fork, never shared between processes
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._loop.run_forever, name="tg-loop", daemon=True
+                ).start()
+            return self._loop
+
+    def run(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        return future.result()
 
 
 class SendMessageToTG(Task):
-    def __init__(self, bot_token):
+    """
+    Sends a chat notification to Telegram. Run the worker with a thread pool
+    (--pool threads) so many sends are in flight per process.
+    Within a process, sends to the same recipient don't overlap and retries
+    happen in place, which keeps a chat under Telegram's flood limits. Their
+    order is not guaranteed, the pool and other processes may pick up a later
+    notification first.
+    Notifications that still fail are pushed to a Redis dead-letter list.
+    """
+
+    # Redeliver if the worker dies mid-send
+    acks_late = True
+
+    def __init__(
+        self,
+        bot_token,
+        redis_client: Redis,
+        max_attempts: int = 5,
+        max_concurrency: int = 100,
+    ):
         super().__init__()
         self.bot_token = bot_token
+        self.redis = redis_client
+        self.max_attempts = max_attempts
+        self.max_concurrency = max_concurrency
+
+        self._runner = AsyncRunner()
+        self._bot: Bot | None = None
+        self._bot_loop: asyncio.AbstractEventLoop | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._recipient_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
 
-    def run(self, chat_id, sender_username, message):
-        bot = Bot(self.bot_token)
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            bot.send_message(
-                chat_id,
-                f"Вам пришло сообщения из чата с <code>{sender_username}</>:\n{message}",
-                parse_mode="HTML",
+    def run(self, chat_id, sender_username, message, count=1):
+        self._runner.run(self._deliver(chat_id, sender_username, message, count))
+
+    def _get_bot(self) -> Bot:
+        # Created inside the loop thread, its aiohttp session is reused by every send
+        loop = asyncio.get_running_loop()
+        if self._bot_loop is not loop:
+            self._bot = Bot(self.bot_token)
+            self._bot_loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._bot
+
+    @staticmethod
+    def _format(sender_username, message, count):
+        # Several messages of a burst arrive as one notification
+        if count > 1:
+            template = (
+                "Новых сообщений из чата с <code>{sender}</>: {count}. "
+                "Последнее:\n{message}"
+            )
+        else:
+            template = "Вам пришло сообщения из чата с <code>{sender}</>:\n{message}"
+
+        # The limit applies to the text after parsing, without tags or escapes
+        visible = len(template.format(sender=sender_username, count=count, message=""))
+        budget = TELEGRAM_MESSAGE_LIMIT - (visible - len("<code></>"))
+        if len(message) > budget:
+            message = message[: max(budget - 1, 0)] + "…"
+
+        # Sent with parse_mode=HTML, a "<" in chat text would be rejected
+        return template.format(
+            sender=html.escape(sender_username),
+            count=count,
+            message=html.escape(message),
+        )
+
+    async def _deliver(self, chat_id, sender_username, message, count=1):
+        bot = self._get_bot()
+
+        lock = self._recipient_locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._recipient_locks[chat_id] = lock
+
+        async with lock:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    async with self._semaphore:
+                        await bot.send_message(
+                            chat_id,
+                            self._format(sender_username, message, count),
+                            parse_mode="HTML",
+                        )
+                    return
+                except TelegramRetryAfter as e:
+                    # Flood control, Telegram says exactly how long to wait
+                    error, delay = e, e.retry_after
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    # Bot blocked or chat gone, retrying won't help
+                    await asyncio.to_thread(
+                        self._dead_letter, chat_id, sender_username, message, e
+                    )
+                    return
+                except Exception as e:
+                    error, delay = e, min(2**attempt, 60)
+
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(delay)
+
+            await asyncio.to_thread(
+                self._dead_letter, chat_id, sender_username, message, error
             )
+
+    def _dead_letter(self, chat_id, sender_username, message, error: Exception):
+        logging.warning(f"Dead-lettering notification for {chat_id}: {error!r}")
+        self.redis.lpush(
+            DEAD_LETTER_KEY,
+            json.dumps(
+                {
+                    "chat_id": chat_id,
+                    "sender_username": sender_username,
+                    "message": message,
+                    "error": repr(error),
+                    "failed_at": int(time.time()),
+                }
+            ),
         )
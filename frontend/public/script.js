@@ -11,15 +11,20 @@ class ChatApp {
         this.messagesDiv = document.getElementById('messages');
         this.messageForm = document.getElementById('message-form');
         this.messageInput = document.getElementById('message-input');
+        this.fileInput = document.getElementById('file-input');
         this.sendBtn = document.getElementById('sendBtn');
         this.connectTGBtn = document.getElementById('connectTelegramBtn');
         this.backBtn = document.getElementById('backBtn');
+        this.peerStatus = document.getElementById('peer-status');
 
         this.userId = null;
         this.username = null;
         this.selectedUserId = null;
         this.token = null;
         this.ws = null;
+        this.typingTimer = null;
+        this.lastTypingSent = 0;
+        this.peerPresence = '';
 
         this.bindEvents();
     }
@@ -30,6 +35,8 @@ class ChatApp {
         this.backBtn.addEventListener('click', () => this.goBack());
         this.sendBtn.addEventListener('click', () => this.sendMessage());
         this.connectTGBtn.addEventListener('click', () => this.connectTelegram());
+        this.messageInput.addEventListener('input', () => this.sendTyping());
+        this.fileInput.addEventListener('change', () => this.sendAttachment());
     }
 
     async handleAuth(action) {
@@ -130,22 +137,132 @@ class ChatApp {
         if (this.ws) {
             this.ws.close();
         }
-        this.ws = new WebSocket(`ws://${window.location.host}/ws/chat/ws/${senderId}/${receiverId}`);
+        // No device_id: the page keeps no messages of its own, so it always
+        // asks for the latest history instead of only what it missed.
+        // conversation lets nginx route both participants to the same backend
+        const conversation = `${Math.min(senderId, receiverId)}:${Math.max(senderId, receiverId)}`;
+        this.ws = new WebSocket(
+            `ws://${window.location.host}/ws/chat/ws/${senderId}/${receiverId}?conversation=${conversation}`
+        );
+
+        const ws = this.ws;
+        ws.onclose = (event) => {
+            // 1012: the server is restarting, 1013: it is draining, try again later
+            if (this.ws !== ws || ![1012, 1013].includes(event.code)) {
+                return;
+            }
+            let retryAfter = Math.random() * 10;
+            try {
+                retryAfter = JSON.parse(event.reason).retry_after;
+            } catch (error) {}
+
+            setTimeout(() => {
+                if (this.ws === ws) {
+                    this.messagesDiv.innerHTML = '';
+                    this.connectToWebSocket(senderId, receiverId);
+                }
+            }, retryAfter * 1000);
+        };
 
         this.ws.onmessage = (event) => {
-            const message = document.createElement('div');
-            message.textContent = event.data;
-            this.messagesDiv.appendChild(message);
-            this.messagesDiv.scrollTop = this.messagesDiv.scrollHeight;
+            if (event.data.startsWith('{')) {
+                this.handleEvent(JSON.parse(event.data));
+                return;
+            }
+
+            this.appendMessage(event.data);
         };
     }
 
+    appendMessage(text) {
+        const message = document.createElement('div');
+        const attachment = text.match(/^(.*?: )\[attachment:([0-9a-f]{64})\] (.*)$/);
+
+        if (attachment) {
+            const [, prefix, id, name] = attachment;
+            const link = document.createElement('a');
+            link.href = `/api/attachments/${id}?name=${encodeURIComponent(name)}`;
+            link.textContent = name || id;
+            message.append(prefix, link);
+        } else {
+            message.textContent = text;
+        }
+
+        this.messagesDiv.appendChild(message);
+        this.messagesDiv.scrollTop = this.messagesDiv.scrollHeight;
+    }
+
+    async sendAttachment() {
+        const file = this.fileInput.files[0];
+        if (!file || !this.ws || this.ws.readyState !== WebSocket.OPEN) {
+            return;
+        }
+
+        try {
+            const response = await fetch(`/api/attachments/?name=${encodeURIComponent(file.name)}`, {
+                method: 'POST',
+                headers: {
+                    'Authorization': `Bearer ${this.token}`,
+                    'Content-Type': 'application/octet-stream',
+                },
+                body: file,
+            });
+
+            if (!response.ok) {
+                alert(response.status === 413 ? 'File is too large.' : 'Upload failed.');
+                return;
+            }
+
+            const { data } = await response.json();
+            this.sendControl({ type: 'attachment', id: data.id, name: data.name });
+            this.appendMessage(`${this.username}: [attachment:${data.id}] ${data.name}`);
+        } catch (error) {
+            console.error('Error uploading attachment:', error);
+        } finally {
+            this.fileInput.value = '';
+        }
+    }
+
+    handleEvent(event) {
+        if (event.type === 'ping') {
+            this.sendControl({ type: 'pong' });
+        } else if (event.type === 'presence') {
+            this.peerPresence = event.status === 'online'
+                ? 'online'
+                : event.last_seen
+                    ? `last seen ${new Date(event.last_seen * 1000).toLocaleString()}`
+                    : 'offline';
+            this.peerStatus.textContent = this.peerPresence;
+        } else if (event.type === 'typing') {
+            this.peerStatus.textContent = 'typing...';
+            clearTimeout(this.typingTimer);
+            this.typingTimer = setTimeout(() => {
+                this.peerStatus.textContent = this.peerPresence;
+            }, 3000);
+        }
+    }
+
+    sendControl(frame) {
+        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+            this.ws.send(JSON.stringify(frame));
+        }
+    }
+
+    sendTyping() {
+        const now = Date.now();
+        if (now - this.lastTypingSent > 1000) {
+            this.lastTypingSent = now;
+            this.sendControl({ type: 'typing' });
+        }
+    }
+
     goBack() {
         if (this.ws) {
             this.ws.close();
             this.ws = null;
         }
         this.messagesDiv.innerHTML = '';
+        this.peerStatus.textContent = '';
         this.chatContainer.style.display = 'none';
         this.userMenu.style.display = 'block';
     }
@@ -154,9 +271,7 @@ class ChatApp {
         const message = this.messageInput.value.trim();
 
         if (message && this.ws && this.ws.readyState === WebSocket.OPEN) {
-            const messageElement = document.createElement('div');
-            messageElement.textContent = `${this.username}: ${message}`;
-            this.messagesDiv.appendChild(messageElement);
+            this.appendMessage(`${this.username}: ${message}`);
 
             this.ws.send(message);
             this.messageInput.value = "";
@@ -7,23 +7,32 @@ from sqlalchemy.ext.asyncio import async_engine_from_config
 
 from alembic import context
 
-from backend.database.database import Base
-from backend.database.models import User
-from backend.config import load_config
-
-backend_config = load_config(".env")
+try:
+    from backend.database.database import Base
+    from backend.database.models import User
+    from backend.config import load_config
+except ImportError:
+    # Running inside the backend container, where backend/ is the working directory
+    from database.database import Base
+    from database.models import User
+    from config import load_config
 
 config = context.config
 
+# The backend passes its own connection (holding the migrations lock)
+external_connection = config.attributes.get("connection")
+
 
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
-config.set_main_option(
-    "sqlalchemy.url",
-    f"postgresql+asyncpg://{backend_config.postgres.db_user}:{backend_config.postgres.db_pass}"
-    f"@localhost:5432/{backend_config.postgres.db_name}?async_fallback=True",
-)
+if external_connection is None:
+    backend_config = load_config(".env")
+    config.set_main_option(
+        "sqlalchemy.url",
+        f"postgresql+asyncpg://{backend_config.postgres.db_user}:{backend_config.postgres.db_pass}"
+        f"@localhost:5432/{backend_config.postgres.db_name}?async_fallback=True",
+    )
 
 target_metadata = Base.metadata
 
@@ -85,5 +94,7 @@ def run_migrations_online() -> None:
 
 if context.is_offline_mode():
     run_migrations_offline()
+elif external_connection is not None:
+    do_run_migrations(external_connection)
 else:
     run_migrations_online()
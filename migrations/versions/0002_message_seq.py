@@ -0,0 +1,57 @@
+"""per-conversation message sequence numbers
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("messages", sa.Column("seq", sa.BigInteger(), nullable=True))
+    # Number existing messages in the order they were stored
+    op.execute(
+        """
+        UPDATE messages
+        SET seq = numbered.seq
+        FROM (
+            SELECT
+                id,
+                row_number() OVER (
+                    PARTITION BY
+                        least(sender_id, receiver_id),
+                        greatest(sender_id, receiver_id)
+                    ORDER BY timestamp, id
+                ) AS seq
+            FROM messages
+        ) AS numbered
+        WHERE messages.id = numbered.id
+        """
+    )
+    op.alter_column("messages", "seq", nullable=False)
+    op.create_index(
+        "ix_messages_conversation_seq",
+        "messages",
+        [
+            sa.text("least(sender_id, receiver_id)"),
+            sa.text("greatest(sender_id, receiver_id)"),
+            "seq",
+        ],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_conversation_seq", table_name="messages")
+    op.drop_column("messages", "seq")